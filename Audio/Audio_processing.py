@@ -3,8 +3,14 @@ import numpy as np
 import matplotlib.pyplot as plt
 import librosa.display
 import pandas as pd
-from scipy.signal import butter, lfilter
+from scipy.signal import butter, sosfilt, resample_poly
+from scipy.fft import dct
 import os
+import warnings
+from math import gcd
+from manifest import file_hash
+from output_backend import get_backend, CsvBackend
+from instrumentation import stage, timed
 
 
 # Set the configuration parameters
@@ -23,14 +29,89 @@ class Config:
         self.window_type = "hann"
         self.fmin = 20
         self.fmax = 8000
+        # Process at the lowest rate sr / k that keeps the band instead of sr, without the MFCCs
+        self.native_rate = False
+        # Folder of the decoded clips cache and its size limit in bytes, None decodes every clip
+        self.cache_dir = None
+        self.cache_size = 2 << 30
+        # Frames with an RMS below this level in dB relative to the normalized peak skip the spectral features, None analyzes every frame
+        self.gate_threshold = None
+        # Drop the frames left out by the gate instead of writing NaN spectral features
+        self.gate_drop = False
+        # Write one row of statistics per clip to a corpus table instead of one CSV of frames per clip
+        self.summary = False
+        # Format of the feature tables, "csv" or "parquet"
+        self.output_format = "csv"
 
-# Set the bandpass filter
-def bandpass_filter(y, config, order=5):
-    nyquist_freq = 0.5 * config.sr
+# Build the audio configuration from the Config of the caller, None keeps the defaults above
+def audio_config(config=None):
+    audio_settings = Config()
+    if config is not None:
+        audio_settings.low_cutoff = config.audio_low_cutoff
+        audio_settings.high_cutoff = config.audio_high_cutoff
+        for name in ["n_fft", "hop_length", "sr", "n_mels", "cmap", "window_type", "fmin", "fmax"]:
+            setattr(audio_settings, name, getattr(config, name, getattr(audio_settings, name)))
+        audio_settings.native_rate = getattr(config, "audio_native_rate", False)
+        audio_settings.cache_dir = getattr(config, "audio_cache_dir", None)
+        audio_settings.cache_size = getattr(config, "audio_cache_size", audio_settings.cache_size)
+        audio_settings.gate_threshold = getattr(config, "audio_gate_threshold", None)
+        audio_settings.gate_drop = getattr(config, "audio_gate_drop", False)
+        audio_settings.summary = getattr(config, "audio_summary", False)
+        audio_settings.output_format = getattr(config, "output_format", "csv")
+    return audio_settings
+
+# Largest k such that sr / k still keeps the band and the frames scale exactly (same timestamps and bins)
+def rate_factor(config):
+    if not config.native_rate:
+        return 1
+    band_top = max(config.high_cutoff, config.fmax)
+    for factor in range(config.sr // 2, 1, -1):
+        if config.sr % factor or config.n_fft % factor or config.hop_length % factor:
+            continue
+        if config.sr / factor / 2 > band_top:
+            return factor
+    return 1
+
+# Constant parts of the feature extraction, built once from the config and reused for every clip
+class AudioFeaturePlan:
+    def __init__(self, config, order=5, n_mfcc=20, n_mfcc_mels=128):
+        self.config = config if isinstance(config, Config) else audio_config(config)
+        self.factor = rate_factor(self.config)
+
+        # Processing rate and frames of the same duration as at config.sr
+        self.sr = self.config.sr // self.factor
+        self.n_fft = self.config.n_fft // self.factor
+        self.hop_length = self.config.hop_length // self.factor
+
+        # Bandpass filter at the two rates a clip can be filtered at
+        self.sos = {sr: bandpass_sos(self.config, sr, order) for sr in {self.config.sr, self.sr}}
+
+        # STFT window and the frequency of each bin
+        self.window = librosa.filters.get_window("hann", self.n_fft, fftbins=True)
+        self.frequencies = librosa.fft_frequencies(sr=self.sr, n_fft=self.n_fft)
+
+        # Mel filter bank of the MFCC at config.sr, its bands go up to config.sr / 2. Above the Nyquist frequency of a
+        # reduced rate they would be empty and change every coefficient, so the native rate computes no MFCCs
+        self.n_mfcc = n_mfcc if self.factor == 1 else 0
+        self.mel_basis = librosa.filters.mel(sr=self.config.sr, n_fft=self.config.n_fft, n_mels=n_mfcc_mels)
+        # DCT-II of the log mel bands, as a matrix
+        self.dct = dct(np.eye(n_mfcc_mels), type=2, norm="ortho", axis=0)[:self.n_mfcc]
+
+        # Writer of the feature tables
+        self.backend = get_backend(self.config)
+
+# Design the bandpass filter at a sampling rate
+def bandpass_sos(config, sr, order=5):
+    nyquist_freq = 0.5 * sr
     low = config.low_cutoff / nyquist_freq
     high = config.high_cutoff / nyquist_freq
-    b, a = butter(order, [low, high], btype="band")
-    y_filtered = lfilter(b, a, y)
+    return butter(order, [low, high], btype="band", output="sos")
+
+# Set the bandpass filter
+def bandpass_filter(y, config, order=5, sr=None, sos=None):
+    if sos is None:
+        sos = bandpass_sos(config, sr or config.sr, order)
+    y_filtered = sosfilt(sos, y, axis=-1)
 
     return y_filtered
 
@@ -39,8 +120,13 @@ def load_audio(file_path):
     y, sr = librosa.load(file_path, sr=None)
     return y, sr
 
-def resample_audio(y, sr, config):
-    y_resampled = librosa.resample(y=y, orig_sr=sr, target_sr=config.sr)
+# Resample to the target rate with a polyphase filter, a clip already at that rate is kept as is
+def resample_audio(y, sr, config, target_sr=None):
+    target_sr = target_sr or config.sr
+    if sr == target_sr:
+        return y
+    divisor = gcd(int(sr), int(target_sr))
+    y_resampled = resample_poly(y, int(target_sr) // divisor, int(sr) // divisor, axis=-1)
     return y_resampled
 
 
@@ -50,59 +136,132 @@ def clean_audio(y):
     y = np.nan_to_num(y, nan=0.0, posinf=0.0, neginf=0.0)
     return y
 
-# Normalize the audio file
+# Normalize the audio file, each row of a batch on its own
 def normalize_audio(y):
-    max_val = np.max(np.abs(y))
-    if max_val > 0:
-        y = y / max_val
+    max_val = np.max(np.abs(y), axis=-1, keepdims=True)
+    y = y / np.where(max_val > 0, max_val, 1)
     return y
 
-# Extract the audio features
-def extract_features(y, config):
-    # Root Mean Square
-    rms = librosa.feature.rms(y=y)
+# Compute the audio features of a clip, or of a batch of clips stacked as rows, y is sampled at plan.sr
+# lengths gives the number of valid samples of each row, the rest is zero padding
+# Returns the timestamps, the feature columns, the MFCCs and the frames the spectral features were computed on
+@timed("features")
+def compute_features(y, plan, lengths=None):
+    single = y.ndim == 1
+    if single:
+        y = y[None]
 
-    # Spectral Centroid
-    spectral_centroid = librosa.feature.spectral_centroid(
-        y=y, sr=config.sr, n_fft=config.n_fft, hop_length=config.hop_length
-    )
+    # Centered frames of the STFT
+    frames = frame_audio(y, plan.n_fft, plan.hop_length)
 
-    # Spectral Bandwidth
-    spectral_bandwidth = librosa.feature.spectral_bandwidth(
-        y=y, sr=config.sr, n_fft=config.n_fft, hop_length=config.hop_length
-    )
+    # Root Mean Square, on the frames of the STFT
+    rms = np.sqrt(np.mean(frames ** 2, axis=-1))
 
-    # Spectral Rolloff
-    spectral_rolloff = librosa.feature.spectral_rolloff(
-        y=y, sr=config.sr, n_fft=config.n_fft, hop_length=config.hop_length
-    )
+    # Zero-Crossing Rate (ZCR), on frames padded with the edge samples so a short clip repeats its last sample
+    y_edge = y
+    if lengths is not None:
+        last = y[np.arange(len(lengths)), np.maximum(lengths, 1) - 1]
+        y_edge = np.where(np.arange(y.shape[-1]) < lengths[:, None], y, last[:, None])
+    zcr = zero_crossing_rate(y_edge, plan.n_fft, plan.hop_length)
+    if plan.factor > 1:
+        # Crossings per sample at config.sr
+        zcr /= plan.factor
 
-    # Zero-Crossing Rate (ZCR)
-    zcr = librosa.feature.zero_crossing_rate(y, hop_length=config.hop_length)
+    # Frames analyzed by the spectral features: the frames of each clip (not its padding) above the gate
+    active = np.ones(rms.shape, dtype=bool)
+    if lengths is not None:
+        active &= np.arange(rms.shape[-1]) < 1 + lengths[:, None] // plan.hop_length
+    if plan.config.gate_threshold is not None:
+        active &= 20 * np.log10(np.maximum(rms, 1e-10)) >= plan.config.gate_threshold
+    clip_index = np.nonzero(active)[0]
 
-    timestamps = librosa.frames_to_time(np.arange(rms.shape[1]), sr=config.sr, hop_length=config.hop_length)
+    # Magnitude spectrum of the analyzed frames, one row per frame (scaled to the magnitude of the frames at config.sr)
+    windowed = frames[active]
+    windowed *= plan.window
+    S = np.abs(np.fft.rfft(windowed, axis=-1))
+    if plan.factor > 1:
+        S *= plan.factor
 
-    # Mel-Frequency Cepstral Coefficients (MFCC)
-    mfcc = librosa.feature.mfcc(y=y, sr=config.sr)
+    # Spectral Centroid, frames without energy are at 0 Hz
+    total = S.sum(axis=-1)
+    total = np.where(total < np.finfo(S.dtype).tiny, 1.0, total)
+    spectral_centroid = (S @ plan.frequencies) / total
 
-    # Load the features into a DataFrame
-    features = pd.DataFrame(
-        {
-            "timestamp": timestamps,
-            "rms": rms[0],
-            "spectral_centroid": spectral_centroid[0],
-            "spectral_bandwidth": spectral_bandwidth[0],
-            "spectral_rolloff": spectral_rolloff[0],
-            "zcr": zcr[0],
-        }
-    )
+    # Spectral Bandwidth, around the centroid computed above
+    deviation = (plan.frequencies - spectral_centroid[:, None]) ** 2
+    spectral_bandwidth = np.sqrt(np.sum(S * deviation, axis=-1) / total)
+
+    # Spectral Rolloff, the first frequency below which 85% of the magnitude lies
+    cumulative = np.cumsum(S, axis=-1)
+    rolloff_bin = np.argmax(cumulative >= 0.85 * cumulative[:, -1:], axis=-1)
+    spectral_rolloff = plan.frequencies[rolloff_bin]
+
+    # Mel-Frequency Cepstral Coefficients (MFCC), from the power of the same spectrum (none at a reduced rate)
+    mfcc_rows = np.empty((len(S), plan.n_mfcc))
+    if plan.n_mfcc:
+        mel_spec = (S ** 2) @ plan.mel_basis.T
+        # Power in dB, limited to 80 dB below the peak of each clip
+        db_mel_spec = 10.0 * np.log10(np.maximum(mel_spec, 1e-10))
+        peak = np.full(len(y), -np.inf)
+        np.maximum.at(peak, clip_index, db_mel_spec.max(axis=-1, initial=-np.inf))
+        db_mel_spec = np.maximum(db_mel_spec, peak[clip_index, None] - 80.0)
+        mfcc_rows = db_mel_spec @ plan.dct.T
+
+    # Put the analyzed frames back in place, the other frames are NaN
+    columns = {"rms": rms}
+    for name, values in [("spectral_centroid", spectral_centroid), ("spectral_bandwidth", spectral_bandwidth), ("spectral_rolloff", spectral_rolloff)]:
+        columns[name] = np.full(rms.shape, np.nan)
+        columns[name][active] = values
+    columns["zcr"] = zcr
+    mfcc = np.full(rms.shape + (len(plan.dct),), np.nan)
+    mfcc[active] = mfcc_rows
+    mfcc = mfcc.swapaxes(-1, -2)
+
+    timestamps = librosa.frames_to_time(np.arange(rms.shape[-1]), sr=plan.sr, hop_length=plan.hop_length)
+
+    if single:
+        return timestamps, {name: values[0] for name, values in columns.items()}, mfcc[0], active[0]
+    return timestamps, columns, mfcc, active
+
+# Load the features of a clip into a DataFrame
+# The frames left out by the gate are dropped, or kept with NaN spectral features
+def features_frame(timestamps, columns, mfcc, active, drop=False):
+    features = pd.DataFrame({"timestamp": timestamps, **columns})
 
     for i in range(mfcc.shape[0]):
         features[f"mfcc_{i+1}"] = mfcc[i]
 
+    if drop:
+        features = features[active].reset_index(drop=True)
+    # Share of the frames the spectral features were computed on
+    features.attrs["analyzed_fraction"] = float(np.mean(active)) if len(active) else 0.0
+    return features
+
+# Extract the audio features, y is sampled at the processing rate of the plan (config.sr unless native_rate)
+def extract_features(y, config, plan=None):
+    plan = plan or AudioFeaturePlan(config)
+    features = features_frame(*compute_features(y, plan), drop=plan.config.gate_drop)
+
     print(pd.DataFrame(features))
     return features
 
+# Centered frames of each clip (zero padded by half a frame on both sides), shape (..., n_frames, n_fft)
+def frame_audio(y, n_fft, hop_length):
+    padding = [(0, 0)] * (y.ndim - 1) + [(n_fft // 2, n_fft // 2)]
+    y = np.pad(y, padding)
+    return np.lib.stride_tricks.sliding_window_view(y, n_fft, axis=-1)[..., ::hop_length, :]
+
+# Fraction of sign changes inside each centered frame (padded with the edge samples), from a prefix sum of the changes
+def zero_crossing_rate(y, frame_length, hop_length, threshold=1e-10):
+    padding = [(0, 0)] * (y.ndim - 1) + [(frame_length // 2, frame_length // 2)]
+    y = np.pad(y, padding, mode="edge")
+    # Samples within the threshold of zero count as positive
+    negative = np.signbit(np.where(np.abs(y) <= threshold, 0.0, y))
+    changes = np.cumsum(negative[..., 1:] != negative[..., :-1], axis=-1)
+    changes = np.concatenate((np.zeros(changes.shape[:-1] + (1,), dtype=changes.dtype), changes), axis=-1)
+    starts = np.arange(0, y.shape[-1] - frame_length + 1, hop_length)
+    return (changes[..., starts + frame_length - 1] - changes[..., starts]) / frame_length
+
 # Display the audio
 def display_audio(y, config):
     # Create a figure and axis
@@ -142,32 +301,272 @@ def display_audio(y, config):
     plt.show()
 
 
-# Save the features to a CSV file
-def save_features(channel_name, save_path, features):
+# Save the features with the output backend, csv by default
+def save_features(channel_name, save_path, features, backend=None):
     df = pd.DataFrame(features)
-    csv_path = os.path.join(save_path, f"{channel_name}.csv")
-    # Save the DataFrame to CSV
-    df.to_csv(csv_path, index=False)
+    backend = backend or CsvBackend()
+    # Save the DataFrame, a clip is its own source
+    with stage("write", channel=channel_name):
+        return backend.write(df, save_path, channel_name, channel_name)
+
+# Name of the features of a clip, its file name without the extension
+def clip_name(file_path):
+    return os.path.splitext(os.path.basename(file_path))[0]
+
+# Load a clip at the rate its bandpass filter runs at: config.sr, unless it is already at the processing rate
+@timed("load")
+def prepare_audio(file_path, plan):
+    if plan.config.cache_dir is not None:
+        return load_cached_audio(file_path, plan)
+    return decode_audio(file_path, plan)
+
+# Decode and resample a clip
+def decode_audio(file_path, plan):
+    y, sr = load_audio(file_path=file_path)
+    if sr != plan.sr:
+        y = resample_audio(y, sr, plan.config)
+        sr = plan.config.sr
+    return y, sr
+
+# Load a clip from the cache, decoding and storing it on a miss
+# The clips are stored as float32 <sha256 of the file>_<rate>.npy and memory-mapped, never copied
+def load_cached_audio(file_path, plan):
+    config = plan.config
+    # The rate the clip is prepared at only depends on its own rate, read from the header
+    source_sr = librosa.get_samplerate(file_path)
+    sr = source_sr if source_sr == plan.sr else config.sr
+    cache_path = os.path.join(config.cache_dir, f"{file_hash(file_path)}_{sr}.npy")
+
+    if os.path.exists(cache_path):
+        # Mark the entry as recently used
+        os.utime(cache_path)
+    else:
+        y, sr = decode_audio(file_path, plan)
+        os.makedirs(config.cache_dir, exist_ok=True)
+        # Write to a temporary file first so a concurrent reader never sees a partial array
+        tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as file:
+            np.save(file, np.asarray(y, dtype=np.float32))
+        os.replace(tmp_path, cache_path)
+        evict_cache(config.cache_dir, config.cache_size, keep=cache_path)
+
+    return np.load(cache_path, mmap_mode="r"), sr
+
+# Delete the least recently used clips until the cache fits in cache_size bytes
+def evict_cache(cache_dir, cache_size, keep=None):
+    entries = []
+    for name in os.listdir(cache_dir):
+        if name.endswith(".npy"):
+            stat = os.stat(os.path.join(cache_dir, name))
+            entries.append((stat.st_mtime_ns, stat.st_size, os.path.join(cache_dir, name)))
+
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total <= cache_size:
+            break
+        if path == keep:
+            continue
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            # Already evicted by another worker
+            pass
+        total -= size
 
 # Extract the audio features from the given file
-def extract_audio_features(file_path, save_path, config):
-    # Load the config 
-    config = Config()
+# Load a clip, filter and normalize it, and bring it to the processing rate of the plan
+def preprocess_audio(file_path, plan):
     # Load the audio file
-    y, sr = load_audio(file_path=file_path)
-    y = resample_audio(y, sr, config)
+    y, sr = prepare_audio(file_path, plan)
+    return filter_audio(y, sr, plan)
+
+# Filter and normalize a clip loaded at sr, and bring it to the processing rate of the plan
+@timed("filter")
+def filter_audio(y, sr, plan):
+    config = plan.config
     # Apply the bandpass filter
-    y = bandpass_filter(y, config=config)
+    y = bandpass_filter(y, config=config, sos=plan.sos[sr])
     # Clean and normalize the audio
     y = clean_audio(y)
     y = normalize_audio(y)
+    # Reduce to the processing rate, the filter response and the scale stay those at config.sr
+    y = resample_audio(y, sr, config, plan.sr)
+    return y
+
+# The plan can be built once with AudioFeaturePlan(config) and passed for every file
+# The features are saved under name, the file name without its extension by default
+def extract_audio_features(file_path, save_path, config, plan=None, name=None):
+    # Load the config 
+    plan = plan or AudioFeaturePlan(config)
+    config = plan.config
+    y = preprocess_audio(file_path, plan)
     # Extract the features
-    features = extract_features(y, config)
+    features = extract_features(y, config, plan)
+    if config.gate_threshold is not None:
+        print(f"Analyzed {100 * features.attrs['analyzed_fraction']:.1f}% of the frames of {file_path}")
 
     # display_audio(y, config)
     # Save the features
-    save_features(
-        channel_name=os.path.splitext(os.path.basename(file_path))[0],
+    csv_path = save_features(
+        channel_name=name or clip_name(file_path),
         save_path=save_path,
         features=features,
+        backend=plan.backend,
     )
+    return [csv_path]
+
+# Load several clips and stack them, zero padded to the longest one, for each rate they are filtered at
+# Yields the indices of the clips in file_paths, the stacked clips at the processing rate and their lengths
+def preprocess_audio_batch(file_paths, plan):
+    config = plan.config
+    clips = [prepare_audio(file_path, plan) for file_path in file_paths]
+
+    # Clips are filtered at the rate they were loaded at, stack the ones sharing it
+    for sr in sorted({clip_sr for _, clip_sr in clips}):
+        index = [i for i, (_, clip_sr) in enumerate(clips) if clip_sr == sr]
+        lengths = np.array([len(clips[i][0]) for i in index])
+        y = np.zeros((len(index), lengths.max()), dtype=np.result_type(*[clips[i][0] for i in index]))
+        for row, i in enumerate(index):
+            y[row, :lengths[row]] = clips[i][0]
+
+        with stage("filter", clips=len(index)):
+            # Apply the bandpass filter, then clear the padding again before the normalization
+            y = bandpass_filter(y, config=config, sos=plan.sos[sr])
+            y = np.where(np.arange(y.shape[-1]) < lengths[:, None], clean_audio(y), 0.0)
+            y = normalize_audio(y)
+
+            # Reduce to the processing rate, the padding stays zero
+            if sr != plan.sr:
+                y = resample_audio(y, sr, config, plan.sr)
+                lengths = -(-lengths * plan.sr // sr)
+                y = np.where(np.arange(y.shape[-1]) < lengths[:, None], y, 0.0)
+
+        yield index, y, lengths
+
+# Extract the audio features of several clips at once, the clips are zero padded to the longest one
+# Same features as extract_audio_features, returns the output paths of each clip
+def extract_audio_features_batch(file_paths, save_path, config, plan=None, names=None):
+    plan = plan or AudioFeaturePlan(config)
+    config = plan.config
+    names = names or [clip_name(file_path) for file_path in file_paths]
+    output_paths = [None] * len(file_paths)
+
+    for index, y, lengths in preprocess_audio_batch(file_paths, plan):
+        timestamps, columns, mfcc, active = compute_features(y, plan, lengths)
+
+        # Split the batch back into clips, with the frames of each clip
+        n_frames = 1 + lengths // plan.hop_length
+        for row, i in enumerate(index):
+            features = features_frame(
+                timestamps[:n_frames[row]],
+                {name: values[row, :n_frames[row]] for name, values in columns.items()},
+                mfcc[row, :, :n_frames[row]],
+                active[row, :n_frames[row]],
+                drop=config.gate_drop,
+            )
+            if config.gate_threshold is not None:
+                print(f"Analyzed {100 * features.attrs['analyzed_fraction']:.1f}% of the frames of {file_paths[i]}")
+            output_paths[i] = [save_features(
+                channel_name=names[i],
+                save_path=save_path,
+                features=features,
+                backend=plan.backend,
+            )]
+
+    print(f"Extracted the features of {len(file_paths)} clips")
+    return output_paths
+
+
+# Statistics of every feature in the per-clip summaries
+SUMMARY_PERCENTILES = [10, 50, 90]
+
+# Stack the feature columns and the MFCCs into one array (..., frames, features) and name its features
+def feature_matrix(columns, mfcc):
+    names = list(columns) + [f"mfcc_{i+1}" for i in range(mfcc.shape[-2])]
+    values = np.concatenate([np.stack(list(columns.values()), axis=-1), mfcc.swapaxes(-1, -2)], axis=-1)
+    return names, values
+
+# Summary rows of clips from their frames (clips, frames, features), NaN frames (gated or past the end) are left out
+@timed("summary")
+def summary_rows(file_paths, names, values, active, n_frames, plan):
+    with warnings.catch_warnings():
+        # A feature without any analyzed frame has NaN statistics
+        warnings.simplefilter("ignore", RuntimeWarning)
+        delta = np.diff(values, axis=1)
+        stats = {
+            "mean": np.nanmean(values, axis=1),
+            "std": np.nanstd(values, axis=1),
+            "min": np.nanmin(values, axis=1),
+            "max": np.nanmax(values, axis=1),
+            **{f"p{q}": percentile for q, percentile in zip(SUMMARY_PERCENTILES, np.nanpercentile(values, SUMMARY_PERCENTILES, axis=1))},
+            # Frame to frame changes
+            "delta_mean": np.nanmean(np.abs(delta), axis=1),
+            "delta_std": np.nanstd(delta, axis=1),
+        }
+
+    rows = []
+    for row, file_path in enumerate(file_paths):
+        summary = {
+            "file": os.path.basename(file_path),
+            "duration": n_frames[row] * plan.hop_length / plan.sr,
+            "analyzed_fraction": float(np.mean(active[row, :n_frames[row]])),
+        }
+        for j, name in enumerate(names):
+            for stat, values_by_clip in stats.items():
+                summary[f"{name}_{stat}"] = values_by_clip[row, j]
+        rows.append(summary)
+    return rows
+
+# Summarize the features of several clips, one row per clip instead of one per frame
+def extract_audio_summary_batch(file_paths, config, plan=None):
+    plan = plan or AudioFeaturePlan(config)
+    rows = [None] * len(file_paths)
+
+    for index, y, lengths in preprocess_audio_batch(file_paths, plan):
+        timestamps, columns, mfcc, active = compute_features(y, plan, lengths)
+        names, values = feature_matrix(columns, mfcc)
+
+        # Leave out the frames of the padding
+        n_frames = 1 + lengths // plan.hop_length
+        values[np.arange(values.shape[1]) >= n_frames[:, None]] = np.nan
+        for i, row in zip(index, summary_rows([file_paths[i] for i in index], names, values, active, n_frames, plan)):
+            rows[i] = row
+
+    return rows
+
+# Summarize the features of a clip
+def extract_audio_summary(file_path, config, plan=None):
+    return extract_audio_summary_batch([file_path], config, plan)[0]
+
+# Feature arrays of several clips for the tensor export, one (1, frames, features) array per clip
+# The frames left out by the gate are NaN, they are never dropped so the rows stay on the frame grid
+def extract_audio_tensor_batch(file_paths, config, plan=None):
+    plan = plan or AudioFeaturePlan(config)
+    parts = [None] * len(file_paths)
+
+    for index, y, lengths in preprocess_audio_batch(file_paths, plan):
+        timestamps, columns, mfcc, active = compute_features(y, plan, lengths)
+        names, values = feature_matrix(columns, mfcc)
+
+        # Split the batch back into clips, without the frames of the padding
+        n_frames = 1 + lengths // plan.hop_length
+        for row, i in enumerate(index):
+            parts[i] = {
+                "values": values[row:row + 1, :n_frames[row]].astype(np.float32),
+                "coords": {"features": names},
+                "analyzed_fraction": float(np.mean(active[row, :n_frames[row]])),
+            }
+
+    return parts
+
+# Write the summaries to the corpus table, keeping the rows of the clips in keep from the previous table
+def save_summary_table(rows, save_path, keep=(), backend=None):
+    backend = backend or CsvBackend()
+    table = pd.DataFrame(rows)
+    previous = backend.read_table(save_path, "audio_summary") if keep else None
+    if previous is not None:
+        table = pd.concat([previous[previous["file"].isin(keep)], table], ignore_index=True)
+    if len(table):
+        table = table.sort_values("file").reset_index(drop=True)
+
+    return backend.write_table(table, save_path, "audio_summary")
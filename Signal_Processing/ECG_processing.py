@@ -2,134 +2,170 @@ import wfdb
 import pandas as pd
 import numpy as np
 import matplotlib.pyplot as plt
-from scipy.signal import butter, filtfilt, find_peaks, savgol_filter
+from scipy.signal import butter, sosfilt, sosfiltfilt, lfilter, find_peaks, savgol_filter
+from functools import lru_cache
 import os
+from output_backend import get_backend, CsvBackend
+from instrumentation import stage, context, timed
 
-# Define the bandpass filter function
-def bandpass_filter(signal, lowcut, highcut, fs, order=4):
+# Context read on each side of a segment in segmented mode, in seconds
+SEGMENT_MARGIN = 5.0
+
+# Per-beat wave durations and intervals of the feature table
+DURATION_COLUMNS = ['P_Wave_duration', 'QRS_duration', 'T_Wave_duration', 'PR_interval', 'QT_interval']
+
+# Design the bandpass filter as second-order sections, once for every (lowcut, highcut, fs, order)
+@lru_cache(maxsize=None)
+def design_bandpass(lowcut, highcut, fs, order=4):
     nyquist_freq = 0.5 * fs
     low = lowcut / nyquist_freq
     high = highcut / nyquist_freq
-    b, a = butter(order, [low, high], btype='band')
-    # Check signal length
-    padlen = 3 * max(len(b), len(a))  # filtfilt pad length
+    return butter(order, [low, high], btype='band', output='sos')
+
+# Define the bandpass filter function
+def bandpass_filter(signal, lowcut, highcut, fs, order=4):
+    sos = design_bandpass(lowcut, highcut, fs, order)
+    # Check signal length, same pad length as filtfilt with the (b, a) coefficients of the filter
+    padlen = 3 * (2 * order + 1)
     # Raise error if the singal not is long enough
     if signal.shape[0] <= padlen:
         raise ValueError(f"The length of the input vector x must be greater than padlen, which is {padlen}.")
-    y = filtfilt(b, a, signal, axis=0)  # Apply along the time axis
+    y = sosfiltfilt(sos, signal, axis=0, padlen=padlen)  # Apply along the time axis
     return y
 
 # Remove the noise of the signal by smoothing it
+@timed("filter")
 def smoothing_singal(signal_data, fs, lowcut, highcut):
-    for i in range(signal_data.shape[1]):
-        signal_data[:, i] = bandpass_filter(signal=signal_data[:, i], lowcut=lowcut, highcut=highcut, fs=fs)
-
-    # Apply Savitzky-Golay filter to each channel
-    smoothed_signals = np.zeros_like(signal_data)
+    # Savitzky-Golay filter window
     window_length = 51  # Ensure this is an odd number and less than the length of the data
 
+    # Ensure the window length is appropriate, if not raise an error
+    if window_length > signal_data.shape[0]:
+        raise ValueError(f"Window length {window_length} is too large for the signal length {signal_data.shape[0]}.")
+    
+    # Filter one channel at a time and write it back into the record, the filters only need copies of a channel
     for i in range(signal_data.shape[1]):
-        # Ensure the window length is appropriate, if not raise an error
-        if window_length > len(signal_data[:, i]):
-            raise ValueError(f"Window length {window_length} is too large for the signal length {len(signal_data[:, i])}.")
-        smoothed_signals[:, i] = savgol_filter(signal_data[:, i], window_length=window_length, polyorder=3)
+        signal_data[:, i] = savgol_filter(
+            bandpass_filter(signal=signal_data[:, i], lowcut=lowcut, highcut=highcut, fs=fs), window_length=window_length, polyorder=3
+        )
     
-    return smoothed_signals
+    return signal_data
     
 
 
-def find_q_s_points(r_peaks, ecg_signal, sampling_freq, range=0.08):
-    # Set up the range to find q_s points
-    window_range = int(sampling_freq * range)
-    q_points = []
-    s_points = []
+# Find the first largest (or smallest) value of values[lo:lo + count] for every window at once
+def window_argext(values, lo, counts, largest=True):
+    lo = np.asarray(lo, dtype=int)
+    counts = np.maximum(np.asarray(counts, dtype=int), 0)
+    result = np.full(len(lo), -1)
+    if len(lo) == 0 or counts.max() == 0:
+        return result
     
-    # loop through all r peaks
-    for peak in r_peaks:
-        # Set up the start and end point for q and s intervals and extract the local min for each intervals
-        q_start_point = max(0, peak - window_range)
-        s_end_point = min(peak + window_range, len(ecg_signal))
+    # One row per window, padded with values that can never be selected
+    offsets = np.arange(counts.max())
+    valid = offsets < counts[:, None]
+    idx = np.where(valid, lo[:, None] + offsets, 0)
+    fill = -np.inf if largest else np.inf
+    window_values = np.where(valid, values[idx], fill)
+    best = np.argmax(window_values, axis=1) if largest else np.argmin(window_values, axis=1)
+    
+    # argmax/argmin return the first occurrence, like the strict comparison of a scan
+    found = counts > 0
+    result[found] = lo[found] + best[found]
+    return result
+
 
-        q_point = q_start_point + np.argmin(ecg_signal[q_start_point:peak])
-        q_points.append(q_point)
+# Find the critical points of the signal from the signs of its derivative, once per signal
+def derivative_sign_points(first_derivative):
+    rising = first_derivative > 0
+    falling = first_derivative < 0
+    n = len(first_derivative)
+    
+    sign_points = {}
+    # Local maxima: rising before x and falling at x
+    sign_points['maxima'] = np.flatnonzero(rising[:n - 1] & falling[1:]) + 1
+    # Onsets: rising on the two samples before j and falling on the two samples after j
+    sign_points['onsets'] = np.flatnonzero(rising[1:n - 3] & rising[:n - 4] & falling[3:n - 1] & falling[4:]) + 2
+    # Offsets: falling on the two samples before j and rising on the two samples after j
+    sign_points['offsets'] = np.flatnonzero(falling[1:n - 3] & falling[:n - 4] & rising[3:n - 1] & rising[4:]) + 2
+    return sign_points
 
-        s_point = peak + np.argmin(ecg_signal[peak:s_end_point])
-        s_points.append(s_point)
 
+def find_q_s_points(r_peaks, ecg_signal, sampling_freq, range=0.08):
+    # Set up the range to find q_s points
+    window_range = int(sampling_freq * range)
+    r_peaks = np.asarray(r_peaks, dtype=int)
+    
+    # Set up the start and end point for q and s intervals and extract the local min for each intervals
+    q_start_points = np.maximum(0, r_peaks - window_range)
+    s_end_points = np.minimum(r_peaks + window_range, len(ecg_signal))
+    
+    q_points = window_argext(ecg_signal, q_start_points, r_peaks - q_start_points, largest=False)
+    s_points = window_argext(ecg_signal, r_peaks, s_end_points - r_peaks, largest=False)
+    
+    # An empty window keeps the R peak itself
+    q_points = np.where(q_points < 0, r_peaks, q_points)
+    s_points = np.where(s_points < 0, r_peaks, s_points)
     return q_points, s_points
 
 
-def find_p_t_points(r_peaks, q_points, s_points, ecg_signal, sampling_freq, p_range=0.4, t_range=0.5):
-    p_points = []
-    t_points = []
-    # Find the deriviatve of the signal
-    first_derivative = np.diff(ecg_signal)
+def find_p_t_points(r_peaks, q_points, s_points, ecg_signal, sampling_freq, p_range=0.4, t_range=0.5, sign_points=None):
+    # Find the local maxima of the signal from the derivative
+    if sign_points is None:
+        sign_points = derivative_sign_points(np.diff(ecg_signal))
+    maxima = sign_points['maxima']
     
-    for i in range(len(r_peaks)):
-        # Pass the first point 
-        if i == 0:
-            continue
-        
-        # Define search window for P wave before the Q wave
-        p_start_point = max(0, r_peaks[i] - int(p_range * sampling_freq))
-        p_end_point = q_points[i]
-
-        # Define search window for T wave after the S wave
-        t_start_point = s_points[i]
-        t_end_point = min(len(ecg_signal), r_peaks[i] + int(t_range * sampling_freq))
-
-        # Find the P point as the maximum within the defined window
-        p_peak_x = None
-        p_peak_y = -np.inf
-        for x in range(p_start_point, p_end_point):
-            if 0 < x < len(first_derivative) and first_derivative[x - 1] > 0 and first_derivative[x] < 0:
-                if ecg_signal[x] > p_peak_y:
-                    p_peak_x = x
-                    p_peak_y = ecg_signal[x]
-        if p_peak_x is not None:
-            p_points.append(p_peak_x)
-
-        # Find the T point as the maximum within the defined window
-        t_peak_x = None
-        t_peak_y = -np.inf
-        for x in range(t_start_point, t_end_point):
-            if 0 < x < len(first_derivative) and first_derivative[x - 1] > 0 and first_derivative[x] < 0:
-                if ecg_signal[x] > t_peak_y:
-                    t_peak_x = x
-                    t_peak_y = ecg_signal[x]
-        if t_peak_x is not None:
-            t_points.append(t_peak_x)
-
+    # Pass the first beat
+    r_peaks = np.asarray(r_peaks, dtype=int)[1:]
+    q_points = np.asarray(q_points, dtype=int)[1:]
+    s_points = np.asarray(s_points, dtype=int)[1:]
+    
+    # Define search window for P wave before the Q wave
+    p_start_points = np.maximum(0, r_peaks - int(p_range * sampling_freq))
+    p_end_points = q_points
+    
+    # Define search window for T wave after the S wave
+    t_start_points = s_points
+    t_end_points = np.minimum(len(ecg_signal), r_peaks + int(t_range * sampling_freq))
+    
+    # Find the P and T points as the highest local maximum within each window
+    maxima_values = ecg_signal[maxima]
+    p_lo = np.searchsorted(maxima, p_start_points)
+    p_idx = window_argext(maxima_values, p_lo, np.searchsorted(maxima, p_end_points) - p_lo)
+    t_lo = np.searchsorted(maxima, t_start_points)
+    t_idx = window_argext(maxima_values, t_lo, np.searchsorted(maxima, t_end_points) - t_lo)
+    
+    # Beats without a local maximum in the window have no point
+    p_points = maxima[p_idx[p_idx >= 0]]
+    t_points = maxima[t_idx[t_idx >= 0]]
     return p_points, t_points
 
 
-def find_onset_offset_points(ecg_signal, peaks, sampling_freq, is_onset, search_range):
-    # Set up the deriviat  ve
-    first_derivative = np.diff(ecg_signal)
-    crit_points = []
-    for peak in peaks:
-        # If finding the onset point
-        if is_onset:
-            start = max(0, peak - int(search_range * sampling_freq))
-            end = peak
-            # Loop through the points and find the critical points
-            for j in range(end - 2, start, -1):
-                if j - 2 < 0:  # Prevent index out of bounnds
-                    break
-                if all(first_derivative[j - k] > 0 for k in range(1, 3)) and all(first_derivative[j + k] < 0 for k in range(1, 3)):
-                    crit_points.append(j)
-                    break
-        else:
-            start = peak
-            end = min(len(ecg_signal) - 1, peak + int(search_range * sampling_freq))\
-            # Loop through the points and find the critical points
-            for j in range(start + 2, end):
-                if j + 2 >= len(first_derivative):  # Ensure we do not go out of bounds
-                    break
-                if all(first_derivative[j - k] < 0 for k in range(1, 3)) and all(first_derivative[j + k] > 0 for k in range(1, 3)):
-                    crit_points.append(j)
-                    break
-    return crit_points
+def find_onset_offset_points(ecg_signal, peaks, sampling_freq, is_onset, search_range, sign_points=None):
+    # Find the critical points of the signal from the derivative
+    if sign_points is None:
+        sign_points = derivative_sign_points(np.diff(ecg_signal))
+    peaks = np.asarray(peaks, dtype=int)
+    search_length = int(search_range * sampling_freq)
+    
+    # If finding the onset point, take the closest critical point before the peak
+    if is_onset:
+        candidates = sign_points['onsets']
+        start = np.maximum(0, peaks - search_length)
+        end = peaks
+        idx = np.searchsorted(candidates, end - 2, side='right') - 1
+        found = idx >= 0
+        found[found] = candidates[idx[found]] > start[found]
+    # Otherwise take the closest critical point after the peak
+    else:
+        candidates = sign_points['offsets']
+        start = peaks
+        end = np.minimum(len(ecg_signal) - 1, peaks + search_length)
+        idx = np.searchsorted(candidates, start + 2)
+        found = idx < len(candidates)
+        found[found] = candidates[idx[found]] < end[found]
+    
+    return candidates[idx[found]]
 
 def plot_signal(ecg_signal, fs, r_peaks, q_points, s_points, p_points, t_points, p_onsets, q_onsets, s_offsets, t_offsets):
     # Convert lists to NumPy arrays
@@ -192,17 +228,31 @@ def plot_signal(ecg_signal, fs, r_peaks, q_points, s_points, p_points, t_points,
 
 
 
-def extract_time_features(ecg_signal, sampling_freq):
-    # Get all the peak points
-    r_peaks, _ = find_peaks(ecg_signal, distance=int(sampling_freq / 2.5), height=np.mean(ecg_signal) + 2*np.std(ecg_signal))
+# Pad or cut the values to n entries, missing entries are NaN
+def fit_length(values, n):
+    fitted = np.full(n, np.nan)
+    length = min(n, len(values))
+    fitted[:length] = values[:length]
+    return fitted
+
+
+@timed("delineation")
+def extract_time_features(ecg_signal, sampling_freq, r_peaks=None):
+    # Get all the peak points, unless the R peaks were already detected
+    if r_peaks is None:
+        r_peaks, _ = find_peaks(ecg_signal, distance=int(sampling_freq / 2.5), height=np.mean(ecg_signal) + 2*np.std(ecg_signal))
+    r_peaks = np.asarray(r_peaks, dtype=int)
     q_points, s_points = find_q_s_points(r_peaks, ecg_signal, sampling_freq)
-    p_points, t_points = find_p_t_points(r_peaks, q_points, s_points, ecg_signal, sampling_freq)
+    
+    # Find the critical points from the derivative once for all the waves
+    sign_points = derivative_sign_points(np.diff(ecg_signal))
+    p_points, t_points = find_p_t_points(r_peaks, q_points, s_points, ecg_signal, sampling_freq, sign_points=sign_points)
 
-    # Find the on/offsets pounts and convert lists to NumPy arrays
-    p_onsets = np.array(find_onset_offset_points(ecg_signal, p_points, sampling_freq, is_onset=True, search_range=0.1))
-    q_onsets = np.array(find_onset_offset_points(ecg_signal, q_points, sampling_freq, is_onset=True, search_range=0.1))
-    t_offsets = np.array(find_onset_offset_points(ecg_signal, t_points, sampling_freq, is_onset=False, search_range=0.2))
-    s_offsets = np.array(find_onset_offset_points(ecg_signal, s_points, sampling_freq, is_onset=False, search_range=0.2))
+    # Find the on/offsets points
+    p_onsets = find_onset_offset_points(ecg_signal, p_points, sampling_freq, is_onset=True, search_range=0.1, sign_points=sign_points)
+    q_onsets = find_onset_offset_points(ecg_signal, q_points, sampling_freq, is_onset=True, search_range=0.1, sign_points=sign_points)
+    t_offsets = find_onset_offset_points(ecg_signal, t_points, sampling_freq, is_onset=False, search_range=0.2, sign_points=sign_points)
+    s_offsets = find_onset_offset_points(ecg_signal, s_points, sampling_freq, is_onset=False, search_range=0.2, sign_points=sign_points)
 
     # Ensure arrays have matching lengths
     min_length = min(len(p_onsets), len(q_onsets))
@@ -230,26 +280,240 @@ def extract_time_features(ecg_signal, sampling_freq):
     min_length = min(len(q_onsets), len(t_offsets))
     qt_intervals = (t_offsets[:min_length] - q_onsets[:min_length]) / sampling_freq
 
-    features = []
-    
-    # Save the features in the dictionary
-    for cycle in range(0, len(r_peaks) - 1):
-        feature = {}
-        rr_interval = r_peaks[cycle + 1] - r_peaks[cycle]
-        bpm = 60.0 / (rr_interval / sampling_freq)
-        feature['RR_interval'] = rr_interval / sampling_freq
-        feature['BPM'] = bpm
-        feature['P_Wave_duration'] = p_wave_durations[cycle] if cycle < len(p_wave_durations) else np.nan
-        feature['QRS_duration'] = qrs_durations[cycle] if cycle < len(qrs_durations) else np.nan
-        feature['T_Wave_duration'] = t_wave_durations[cycle] if cycle < len(t_wave_durations) else np.nan
-        feature['PR_interval'] = pr_intervals[cycle] if cycle < len(pr_intervals) else np.nan
-        feature['QT_interval'] = qt_intervals[cycle] if cycle < len(qt_intervals) else np.nan
-        features.append(feature)
+    # Save the features of every cycle as columns, missing values are NaN
+    n_cycles = max(len(r_peaks) - 1, 0)
+    rr_intervals = np.diff(r_peaks) / sampling_freq
+    features = {'RR_interval': rr_intervals, 'BPM': 60.0 / rr_intervals}
+    for column, values in zip(DURATION_COLUMNS, (p_wave_durations, qrs_durations, t_wave_durations, pr_intervals, qt_intervals)):
+        features[column] = fit_length(values, n_cycles)
 
     return features, r_peaks, q_points, s_points, p_points, t_points, p_onsets, q_onsets, s_offsets, t_offsets
 
 
-def read_signal(file_path):
+# Online R peak detector in the style of Pan-Tompkins, fed with chunks of samples
+class StreamingRPeakDetector:
+    # Set up the filters and the adaptive thresholds, all the state has a fixed size
+    def __init__(self, sampling_freq, lowcut=5.0, highcut=15.0, integration_window=0.15, refractory=0.4, learning_duration=2.0):
+        self.sampling_freq = sampling_freq
+        
+        # Bandpass filter on the QRS band
+        self.sos = design_bandpass(lowcut, highcut, sampling_freq, order=2)
+        self.filter_state = np.zeros((self.sos.shape[0], 2))
+        
+        # Five-point derivative
+        self.derivative = np.array([2.0, 1.0, 0.0, -1.0, -2.0]) * sampling_freq / 8
+        self.derivative_state = np.zeros(len(self.derivative) - 1)
+        
+        # Moving window integration of the squared derivative
+        window_size = max(1, int(integration_window * sampling_freq))
+        self.integration = np.full(window_size, 1.0 / window_size)
+        self.integration_state = np.zeros(window_size - 1)
+        
+        # Minimum distance between beats, same default as the threshold detector (150 BPM)
+        self.refractory = int(refractory * sampling_freq)
+        self.learning_size = int(learning_duration * sampling_freq)
+        # The R peak is up to an integration window (plus the filter delays) before the integrated peak
+        self.search_size = window_size + int(0.05 * sampling_freq)
+        
+        # Samples kept until their peaks are confirmed, the first one is sample buffer_start of the stream
+        self.integrated = np.empty(0)
+        self.signal = np.empty(0)
+        self.buffer_start = 0
+        self.next_position = 0  # First sample not yet considered for a peak
+        
+        # Running estimates of the signal and noise peak levels
+        self.signal_peak = 0.0
+        self.noise_peak = 0.0
+        self.threshold = None
+        self.last_beat = None
+    
+    # Feed a chunk of samples, return the stream indices of the beats confirmed by it
+    def update(self, chunk):
+        chunk = np.asarray(chunk, dtype=float)
+        filtered, self.filter_state = sosfilt(self.sos, chunk, zi=self.filter_state)
+        derivative, self.derivative_state = lfilter(self.derivative, 1.0, filtered, zi=self.derivative_state)
+        integrated, self.integration_state = lfilter(self.integration, 1.0, derivative ** 2, zi=self.integration_state)
+        
+        self.integrated = np.concatenate((self.integrated, integrated))
+        self.signal = np.concatenate((self.signal, chunk))
+        
+        # Initialize the thresholds from the first seconds of the stream
+        if self.threshold is None:
+            if len(self.integrated) < self.learning_size:
+                return np.empty(0, dtype=int)
+            self.signal_peak = 0.25 * np.max(self.integrated)
+            self.noise_peak = 0.5 * np.mean(self.integrated)
+            self.threshold = self.noise_peak + 0.25 * (self.signal_peak - self.noise_peak)
+        
+        # A peak is confirmed once a refractory period after it has been seen
+        return self.confirm_peaks(len(self.integrated) - self.refractory)
+    
+    # Confirm the peaks left at the end of the stream
+    def flush(self):
+        if self.threshold is None and len(self.integrated):
+            self.signal_peak = 0.25 * np.max(self.integrated)
+            self.noise_peak = 0.5 * np.mean(self.integrated)
+            self.threshold = self.noise_peak + 0.25 * (self.signal_peak - self.noise_peak)
+        return self.confirm_peaks(len(self.integrated))
+    
+    # Classify the peaks of the buffer before stop as beats or noise, then drop the samples no longer needed
+    def confirm_peaks(self, stop):
+        peaks, _ = find_peaks(self.integrated, distance=self.refractory)
+        first = self.next_position - self.buffer_start
+        peaks = peaks[(peaks >= first) & (peaks < stop)]
+        
+        beats = []
+        for peak in peaks:
+            value = self.integrated[peak]
+            if value > self.threshold:
+                # Locate the R peak on the input signal just before the integrated peak
+                search_start = max(0, peak - self.search_size)
+                r_peak = self.buffer_start + search_start + int(np.argmax(self.signal[search_start:peak + 1]))
+                if self.last_beat is None or r_peak - self.last_beat >= self.refractory:
+                    beats.append(r_peak)
+                    self.last_beat = r_peak
+                    self.signal_peak = 0.125 * value + 0.875 * self.signal_peak
+                else:
+                    self.noise_peak = 0.125 * value + 0.875 * self.noise_peak
+            else:
+                self.noise_peak = 0.125 * value + 0.875 * self.noise_peak
+            self.threshold = self.noise_peak + 0.25 * (self.signal_peak - self.noise_peak)
+        
+        # Keep the unconfirmed samples and the R peak search context before them
+        if stop > first:
+            self.next_position = self.buffer_start + stop
+        drop = max(0, self.next_position - self.buffer_start - self.search_size)
+        self.integrated = self.integrated[drop:]
+        self.signal = self.signal[drop:]
+        self.buffer_start += drop
+        return np.array(beats, dtype=int)
+
+
+# Detect the R peaks of a signal by streaming it through the online detector
+@timed("r_peaks")
+def detect_r_peaks_streaming(ecg_signal, sampling_freq, chunk_duration=1.0):
+    detector = StreamingRPeakDetector(sampling_freq)
+    chunk_size = max(1, int(chunk_duration * sampling_freq))
+    beats = [detector.update(ecg_signal[start:start + chunk_size]) for start in range(0, len(ecg_signal), chunk_size)]
+    beats.append(detector.flush())
+    return np.concatenate(beats)
+
+
+# Frequency bands of the heart rate variability in Hz
+HRV_BANDS = {'LF': (0.04, 0.15), 'HF': (0.15, 0.4)}
+HRV_FREQUENCIES = np.linspace(0.04, 0.4, 145)
+LOMB_BATCH_SIZE = 1 << 21  # Windows x beats x frequencies evaluated at once
+
+
+# First and last+1 RR interval of each window, an interval belongs to the window of the beat ending it
+def hrv_window_bounds(r_peaks, sampling_freq, window_duration, time_step, n_samples):
+    window_size = int(window_duration * sampling_freq)
+    step_size = int(time_step * sampling_freq)
+    starts = np.arange(0, n_samples - window_size + 1, step_size)
+    lo = np.searchsorted(r_peaks[1:], starts)
+    hi = np.searchsorted(r_peaks[1:], starts + window_size)
+    return lo, hi
+
+
+# SDNN, RMSSD and pNN50 of every window from prefix sums over the RR intervals
+def hrv_time_features(rr_intervals, lo, hi):
+    # Center on the global mean so the prefix sums of the squares do not cancel
+    centered = rr_intervals - (rr_intervals.mean() if len(rr_intervals) else 0.0)
+    sum_rr = np.concatenate(([0.0], np.cumsum(centered)))
+    sum_sq = np.concatenate(([0.0], np.cumsum(centered ** 2)))
+    count = hi - lo
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = (sum_rr[hi] - sum_rr[lo]) / count
+        sdnn = np.sqrt(np.maximum((sum_sq[hi] - sum_sq[lo] - count * mean ** 2) / (count - 1), 0))
+    sdnn[count < 2] = np.nan
+    
+    # Successive differences, the difference k needs the intervals k and k+1 inside the window
+    differences = np.diff(rr_intervals)
+    sum_diff_sq = np.concatenate(([0.0], np.cumsum(differences ** 2)))
+    sum_nn50 = np.concatenate(([0], np.cumsum(np.abs(differences) > 0.05)))
+    diff_hi = np.maximum(hi - 1, lo)
+    n_diff = diff_hi - lo
+    with np.errstate(invalid='ignore', divide='ignore'):
+        rmssd = np.sqrt((sum_diff_sq[diff_hi] - sum_diff_sq[lo]) / n_diff)
+        pnn50 = 100.0 * (sum_nn50[diff_hi] - sum_nn50[lo]) / n_diff
+    rmssd[n_diff < 1] = np.nan
+    pnn50[n_diff < 1] = np.nan
+    
+    return {
+        'Mean_RR': mean + (rr_intervals.mean() if len(rr_intervals) else 0.0),
+        'SDNN': sdnn * 1000,
+        'RMSSD': rmssd * 1000,
+        'pNN50': pnn50,
+    }
+
+
+# Lomb-Scargle LF and HF powers of the unevenly sampled RR series of every window, in ms^2
+def hrv_frequency_features(beat_times, rr_intervals, lo, hi, frequencies=HRV_FREQUENCIES):
+    n_windows = len(lo)
+    count = hi - lo
+    powers = {band: np.full(n_windows, np.nan) for band in HRV_BANDS}
+    if n_windows == 0 or count.max() < 4:
+        return powers
+    
+    # Pad the RR series of the windows into one matrix, masked beyond the beats of each window
+    width = count.max()
+    index = lo[:, None] + np.arange(width)
+    mask = np.arange(width) < count[:, None]
+    index = np.minimum(index, len(rr_intervals) - 1)
+    omega = 2 * np.pi * frequencies
+    band_masks = {band: (frequencies >= low) & (frequencies <= high) for band, (low, high) in HRV_BANDS.items()}
+    
+    batch_size = max(1, LOMB_BATCH_SIZE // (width * len(frequencies)))
+    for start in range(0, n_windows, batch_size):
+        batch = slice(start, start + batch_size)
+        batch_mask = mask[batch]
+        times = np.where(batch_mask, beat_times[index[batch]], 0.0)
+        values = np.where(batch_mask, rr_intervals[index[batch]], 0.0)
+        n = count[batch]
+        values = np.where(batch_mask, values - values.sum(axis=1, keepdims=True) / np.maximum(n, 1)[:, None], 0.0)
+        
+        # Time shift tau of every window and frequency, then the classical Lomb-Scargle sums
+        phase = omega[None, None, :] * times[:, :, None]
+        weight = batch_mask[:, :, None]
+        tau = np.arctan2((np.sin(2 * phase) * weight).sum(axis=1), (np.cos(2 * phase) * weight).sum(axis=1)) / (2 * omega)
+        shifted = phase - omega[None, None, :] * tau[:, None, :]
+        cos_shifted = np.cos(shifted) * weight
+        sin_shifted = np.sin(shifted) * weight
+        with np.errstate(invalid='ignore', divide='ignore'):
+            periodogram = 0.5 * ((values[:, :, None] * cos_shifted).sum(axis=1) ** 2 / (cos_shifted ** 2).sum(axis=1)
+                                 + (values[:, :, None] * sin_shifted).sum(axis=1) ** 2 / (sin_shifted ** 2).sum(axis=1))
+            # One-sided spectral density in s^2/Hz, the mean RR interval is the average sampling period
+            mean_rr = (times.max(axis=1) - times[:, 0]) / np.maximum(n - 1, 1)
+            density = 2 * periodogram * mean_rr[:, None]
+        
+        for band, band_mask in band_masks.items():
+            band_power = np.trapz(density[:, band_mask], frequencies[band_mask], axis=1) * 1e6
+            band_power[n < 4] = np.nan
+            powers[band][batch] = band_power
+    
+    return powers
+
+
+# Windowed heart rate variability features of a channel, with the windows of the EEG features
+@timed("hrv")
+def extract_hrv_features(r_peaks, sampling_freq, window_duration, time_step, n_samples):
+    r_peaks = np.asarray(r_peaks, dtype=int)
+    beat_times = r_peaks / sampling_freq
+    rr_intervals = np.diff(beat_times)
+    lo, hi = hrv_window_bounds(r_peaks, sampling_freq, window_duration, time_step, n_samples)
+    
+    features = {'Window_index': np.arange(1, len(lo) + 1)}
+    features.update(hrv_time_features(rr_intervals, lo, hi))
+    powers = hrv_frequency_features(beat_times[1:], rr_intervals, lo, hi)
+    features['LF_power'] = powers['LF']
+    features['HF_power'] = powers['HF']
+    with np.errstate(invalid='ignore', divide='ignore'):
+        features['LF_HF_ratio'] = powers['LF'] / powers['HF']
+    return pd.DataFrame(features)
+
+
+# Get the record path of a WFDB signal file, checking its header exists
+def get_record_path(file_path):
     # Extract the base name without the directory path and extension
     base_name = os.path.splitext(os.path.basename(file_path))[0]
     # Construct the header file path
@@ -258,9 +522,13 @@ def read_signal(file_path):
     # Check if the header file exists
     if not os.path.exists(header_file):
         raise FileNotFoundError(f"No header file found for {file_path}")
-    
-    # Read the header and record
-    record = wfdb.rdrecord(os.path.join(os.path.dirname(file_path), base_name))
+    return os.path.join(os.path.dirname(file_path), base_name)
+
+
+@timed("load")
+def read_signal(file_path, sampfrom=0, sampto=None):
+    # Read the header and record, or only the samples [sampfrom, sampto) of it
+    record = wfdb.rdrecord(get_record_path(file_path), sampfrom=sampfrom, sampto=sampto)
     signal = record.p_signal
     fs = record.fs
     
@@ -268,22 +536,115 @@ def read_signal(file_path):
 
 
 
-def save_features(channel_name, save_path , df):
-    csv_path = os.path.join(save_path, f"{channel_name}.csv")
-    df.to_csv(csv_path, index=False)
+# Save the features of a channel with the output backend, csv by default
+def save_features(channel_name, save_path , df, source=None, backend=None, table="features"):
+    backend = backend or CsvBackend()
+    with stage("write", channel=channel_name, table=table):
+        return backend.write(df, save_path, source, channel_name, table)
+
+
+# Save the windowed HRV features of a channel next to its beat features
+def save_hrv_features(channel_name, save_path, r_peaks, sampling_freq, n_samples, config, source=None, backend=None):
+    df = extract_hrv_features(r_peaks, sampling_freq, config.window_duration, config.time_step, n_samples)
+    return save_features(channel_name, save_path, df, source, backend, table="hrv")
+
+
+# Read and delineate the record one segment at a time, the margins are only used as context
+def extract_ecg_features_segmented(file_path, save_path, config):
+    header = wfdb.rdheader(get_record_path(file_path))
+    fs = header.fs
+    segment_size = int(fs * config.ecg_segment_duration)
+    margin = int(fs * SEGMENT_MARGIN)
+    refractory = int(fs / 2.5)  # Same minimum distance between beats as the R peak detection
+    
+    # R peaks and per-beat durations of every channel, collected segment by segment
+    r_peaks = [[] for _ in range(header.n_sig)]
+    durations = [[] for _ in range(header.n_sig)]
+    
+    # The streaming detector of each channel runs across the segments, it sees every sample once
+    if config.ecg_r_peak_detector == "streaming":
+        detectors = [StreamingRPeakDetector(fs) for _ in range(header.n_sig)]
+    
+    for core_start in range(0, header.sig_len, segment_size):
+        core_stop = min(core_start + segment_size, header.sig_len)
+        
+        # Read the segment with a margin on both sides so the filter edges and wave searches stay outside its core
+        read_start = max(0, core_start - margin)
+        read_stop = min(header.sig_len, core_stop + margin)
+        _, signal = read_signal(file_path, read_start, read_stop)
+        smoothed_signal = smoothing_singal(signal, fs, config.ecg_low_cutoff, config.ecg_high_cutoff)
+        
+        for i in range(smoothed_signal.shape[1]):
+            with context(channel=i+1, segment_start=core_start):
+                if config.ecg_r_peak_detector == "streaming":
+                    # Feed the core of the segment, the confirmed beats lag by less than the margin
+                    with stage("r_peaks"):
+                        beats = detectors[i].update(smoothed_signal[core_start - read_start:core_stop - read_start, i])
+                        if core_stop == header.sig_len:
+                            beats = np.concatenate((beats, detectors[i].flush()))
+                    features, segment_peaks = extract_time_features(smoothed_signal[:, i], fs, beats - read_start)[:2]
+                else:
+                    features, segment_peaks = extract_time_features(smoothed_signal[:, i], fs)[:2]
+            segment_peaks = segment_peaks + read_start
+            
+            # Durations of the cycle starting at each beat, the last beat of the segment has none
+            segment_durations = np.column_stack([fit_length(features[column], len(segment_peaks)) for column in DURATION_COLUMNS])
+            
+            # Keep the beats of the core, the ones in the margins belong to the neighbouring segments
+            # (the streaming detector emits every beat once, it may still lie in the previous core)
+            if config.ecg_r_peak_detector == "streaming":
+                core = np.ones(len(segment_peaks), dtype=bool)
+            else:
+                core = (segment_peaks >= core_start) & (segment_peaks < core_stop)
+            r_peaks[i].append(segment_peaks[core])
+            durations[i].append(segment_durations[core])
+    
+    output_paths = []
+    source = os.path.splitext(os.path.basename(file_path))[0]
+    backend = get_backend(config)
+    for i in range(header.n_sig):
+        channel_peaks = np.concatenate(r_peaks[i]) if r_peaks[i] else np.empty(0, dtype=int)
+        channel_durations = np.concatenate(durations[i]) if durations[i] else np.empty((0, len(DURATION_COLUMNS)))
+        
+        # Drop a beat detected twice at a segment boundary
+        keep = np.ones(len(channel_peaks), dtype=bool)
+        keep[1:] = np.diff(channel_peaks) >= refractory
+        channel_peaks = channel_peaks[keep]
+        channel_durations = channel_durations[keep]
+        
+        # RR intervals across the segment boundaries, one row per cycle like the whole-record path
+        rr_intervals = np.diff(channel_peaks) / fs
+        features = {'RR_interval': rr_intervals, 'BPM': 60.0 / rr_intervals}
+        for column, values in zip(DURATION_COLUMNS, channel_durations[:-1].T):
+            features[column] = values
+        with context(channel=i+1):
+            output_paths.append(save_features(i+1, save_path, pd.DataFrame(features), source, backend))
+            if config.ecg_hrv:
+                output_paths.append(save_hrv_features(i+1, save_path, channel_peaks, fs, header.sig_len, config, source, backend))
+    
+    return output_paths
 
 
 def extract_ecg_features(file_path, save_path, config):
+        # Long records are read a segment at a time to bound the memory use
+        if config.ecg_segment_duration is not None:
+            return extract_ecg_features_segmented(file_path, save_path, config)
+        
         fs, signal = read_signal(file_path)
         smoothed_signal = smoothing_singal(signal, fs, config.ecg_low_cutoff, config.ecg_high_cutoff)
+        output_paths = []
+        source = os.path.splitext(os.path.basename(file_path))[0]
+        backend = get_backend(config)
         for i in range(smoothed_signal.shape[1]):
             # Extract features and detect peaks
             channel_signal = smoothed_signal[:, i]
-            features, r_peaks, q_points, s_points, p_points, t_points, p_onsets, q_onsets, s_offsets, t_offsets = extract_time_features(channel_signal, fs)
-            df_features = pd.DataFrame(features)
-            #plot_signal(channel_signal, r_peaks, q_points, s_points, p_points, t_points, p_onsets, q_onsets, s_offsets, t_offsets)
-            save_features(i+1, save_path, df_features)
-        
+            with context(channel=i+1):
+                r_peaks = detect_r_peaks_streaming(channel_signal, fs) if config.ecg_r_peak_detector == "streaming" else None
+                features, r_peaks, q_points, s_points, p_points, t_points, p_onsets, q_onsets, s_offsets, t_offsets = extract_time_features(channel_signal, fs, r_peaks)
+                df_features = pd.DataFrame(features)
+                #plot_signal(channel_signal, r_peaks, q_points, s_points, p_points, t_points, p_onsets, q_onsets, s_offsets, t_offsets)
+                output_paths.append(save_features(i+1, save_path, df_features, source, backend))
+                if config.ecg_hrv:
+                    output_paths.append(save_hrv_features(i+1, save_path, r_peaks, fs, len(channel_signal), config, source, backend))
         
-        
-
+        return output_paths
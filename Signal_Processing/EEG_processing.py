@@ -3,9 +3,26 @@ import pandas as pd
 import matplotlib.pyplot as plt
 import numpy as np
 from scipy.stats import skew, kurtosis
-from scipy.signal import welch
+from scipy.signal import welch, spectrogram, firwin, kaiserord, resample_poly
 from scipy.integrate import simps
+from functools import lru_cache
+from math import gcd
+import json
 import os
+from output_backend import get_backend, CsvBackend
+from instrumentation import stage, timed
+
+# Frequency bands used for the band powers
+BANDS = {
+    "delta": (0.5, 4),
+    "theta": (4, 8),
+    "alpha": (8, 12),
+    "beta": (12, 30),
+    "gamma": (30, 100)
+}
+
+# Number of samples processed at once by the batched engine, bounds its memory use
+BATCH_SAMPLES = 1 << 22
 
 def extract_time_domain_features(window):
     # Calculate mean, variance, skewness, and kurtosis of the window
@@ -23,17 +40,8 @@ def extract_frequency_domain_features(window, sampling_freq, window_size):
     freqs_res = freqs[1] - freqs[0]  # Frequency resolution
     total_power = simps(psd, dx=freqs_res)  # Total power in the signal
     features = {}
-
-    # Define frequency bands
-    bands = {
-        "delta": (0.5, 4),
-        "theta": (4, 8),
-        "alpha": (8, 12),
-        "beta": (12, 30),
-        "gamma": (30, 100)
-    }
     
-    for band, (low, high) in bands.items():
+    for band, (low, high) in BANDS.items():
         # Find the indices of the frequencies within the band
         idx = np.logical_and(freqs >= low, freqs <= high)
         # Calculate absolute band power using Simpson's rule for numerical integration
@@ -56,7 +64,7 @@ def moving_window(data, window_duration, time_step, sampling_freq):
     step_size = int(sampling_freq * time_step)  # Number of samples to step
     
     for i in range(0, len(data) - window_size + 1, step_size):
-        window = data['amplitude'][i:min(i + window_size, len(data['time']))]
+        window = data['amplitude'][i:min(i + window_size, len(data))]
         
         features = {}
         features['Window_index'] = i // step_size + 1  # Index of the window
@@ -69,33 +77,398 @@ def moving_window(data, window_duration, time_step, sampling_freq):
     
     return pd.DataFrame(features_list)
 
-def save_features(channel_name, save_path, df):
-            csv_path = os.path.join(save_path, f"{channel_name}.csv")
-            df.to_csv(csv_path, index=False)
-            
+# Get the weights of Simpson's rule, so that simps(y, dx=dx) equals y @ weights
+def simpson_weights(n, dx, chunk_size=256):
+    weights = np.empty(n)
+    # Integrate the unit vectors a chunk at a time to keep the identity matrix small
+    for start in range(0, n, chunk_size):
+        rows = min(chunk_size, n - start)
+        basis = np.zeros((rows, n))
+        basis[np.arange(rows), start + np.arange(rows)] = 1
+        weights[start:start + rows] = simps(basis, dx=dx, axis=-1)
+    return weights
+
+# Build the weight matrix mapping a PSD to its total power and band powers
+@lru_cache(maxsize=None)
+def band_power_weights(sampling_freq, window_size):
+    freqs = np.fft.rfftfreq(window_size, 1 / sampling_freq)
+    freqs_res = freqs[1] - freqs[0]  # Frequency resolution
+    
+    # First column is the total power, then one column per band
+    weights = np.zeros((len(freqs), len(BANDS) + 1))
+    weights[:, 0] = simpson_weights(len(freqs), freqs_res)
+    for column, (low, high) in enumerate(BANDS.values(), start=1):
+        idx = np.flatnonzero(np.logical_and(freqs >= low, freqs <= high))
+        weights[idx, column] = simpson_weights(len(idx), freqs_res)
+    return weights
+
+# Compute mean, variance, skewness and kurtosis of every window from prefix sums of x, x^2, x^3 and x^4
+def rolling_time_domain_features(signal, window_size, step_size, n_windows):
+    # Works on the last axis, signal is (samples,) or (channels, samples)
+    moments = np.empty(signal.shape[:-1] + (n_windows, 4))
+    # Short blocks of a few window lengths keep the sums local, the overlap costs about a third more work
+    block_windows = max(1, 4 * window_size // step_size)
+    
+    for start in range(0, n_windows, block_windows):
+        stop = min(start + block_windows, n_windows)
+        segment = signal[..., start * step_size:(stop - 1) * step_size + window_size]
+        
+        # Center each block on its own mean so drift and DC offsets do not cancel out the precision
+        reference = np.mean(segment, axis=-1, keepdims=True)
+        centered = segment - reference
+        
+        # Prefix sums of the powers of the signal, with a leading zero
+        prefix = np.zeros((4,) + centered.shape[:-1] + (centered.shape[-1] + 1,))
+        power = centered.copy()
+        for order in range(4):
+            np.cumsum(power, axis=-1, out=prefix[order, ..., 1:])
+            power *= centered
+        
+        # Raw moments of every window around the block reference
+        window_starts = np.arange(stop - start) * step_size
+        raw = (prefix[..., window_starts + window_size] - prefix[..., window_starts]) / window_size
+        
+        # Number of changes between consecutive samples of every window, counted exactly so constant windows
+        # (e.g. a flat dropout) are found whatever the rounding left in their variance
+        changes = np.zeros(centered.shape[:-1] + (centered.shape[-1],), dtype=np.int64)
+        np.cumsum(np.diff(segment, axis=-1) != 0, axis=-1, out=changes[..., 1:])
+        constant = changes[..., window_starts + window_size - 1] == changes[..., window_starts]
+        m1, r2, r3, r4 = raw
+        
+        # Central moments from the raw moments
+        m2 = np.maximum(r2 - m1 ** 2, 0)
+        m3 = r3 - 3 * m1 * r2 + 2 * m1 ** 3
+        m4 = r4 - 4 * m1 * r3 + 6 * m1 ** 2 * r2 - 3 * m1 ** 4
+        mean = reference + m1
+        
+        # Same convention as scipy, skewness and kurtosis are NaN for constant windows
+        zero = constant | (m2 <= (np.finfo(float).resolution * mean) ** 2)
+        m2[constant] = 0
+        with np.errstate(divide='ignore', invalid='ignore'):
+            moments[..., start:stop, 0] = mean
+            moments[..., start:stop, 1] = m2
+            moments[..., start:stop, 2] = np.where(zero, np.nan, m3 / m2 ** 1.5)
+            moments[..., start:stop, 3] = np.where(zero, np.nan, m4 / m2 ** 2 - 3)
+    
+    return moments
+
+# Compute the features of all the windows in a few batched calls instead of one window at a time
+def moving_window_batched(signal, window_duration, time_step, sampling_freq, rolling_moments=False):
+    return moving_window_multichannel(signal[np.newaxis], window_duration, time_step, sampling_freq, rolling_moments)[0]
+
+# Compute the window features of every channel of a (channels, samples) array in one pass
+def moving_window_multichannel(data, window_duration, time_step, sampling_freq, rolling_moments=False, shared_segments=False):
+    window_size = int(sampling_freq * window_duration)  # Number of samples per window
+    step_size = int(sampling_freq * time_step)  # Number of samples to step
+    
+    n_channels, n_samples = data.shape
+    n_windows = (n_samples - window_size) // step_size + 1 if n_samples >= window_size else 0
+    if n_windows == 0:
+        return [pd.DataFrame() for _ in range(n_channels)]
+    
+    # Rolling moments cost O(n) whatever the window length
+    if rolling_moments:
+        moments = rolling_time_domain_features(data, window_size, step_size, n_windows)
+    else:
+        moments = batched_time_domain_features(data, window_size, step_size, n_windows)
+    
+    if shared_segments:
+        powers = segment_band_powers(data, window_size, step_size, n_windows, sampling_freq)
+    else:
+        powers = welch_band_powers(data, window_size, step_size, n_windows, sampling_freq)
+    
+    return [window_features_frame(moments[channel], powers[channel]) for channel in range(n_channels)]
+
+# Get a strided view of the windows of every channel, (channels, windows, samples), no data is copied
+def window_view(data, window_size, step_size, n_windows):
+    return np.lib.stride_tricks.sliding_window_view(data, window_size, axis=-1)[:, ::step_size][:, :n_windows]
+
+# Compute mean, variance, skewness and kurtosis of the windows, a batch of windows at a time
+def batched_time_domain_features(data, window_size, step_size, n_windows):
+    windows = window_view(data, window_size, step_size, n_windows)
+    batch_size = max(1, BATCH_SAMPLES // (window_size * len(data)))
+    
+    moments = np.empty((len(data), n_windows, 4))
+    for start in range(0, n_windows, batch_size):
+        batch = windows[:, start:start + batch_size]
+        moments[:, start:start + batch.shape[1]] = np.stack(
+            (np.mean(batch, axis=-1), np.var(batch, axis=-1), skew(batch, axis=-1), kurtosis(batch, axis=-1)),
+            axis=-1,
+        )
+    return moments
+
+# Compute the total and band powers of the windows with one Welch PSD per window
+def welch_band_powers(data, window_size, step_size, n_windows, sampling_freq):
+    windows = window_view(data, window_size, step_size, n_windows)
+    weights = band_power_weights(sampling_freq, window_size)
+    batch_size = max(1, BATCH_SAMPLES // (window_size * len(data)))
+    
+    powers = np.empty((len(data), n_windows, len(BANDS) + 1))
+    for start in range(0, n_windows, batch_size):
+        batch = windows[:, start:start + batch_size]
+        # PSD of every window in one call, then total and band powers in one matrix multiply
+        _, psd = welch(batch, fs=sampling_freq, nperseg=window_size, axis=-1)
+        powers[:, start:start + batch.shape[1]] = psd @ weights
+    return powers
+
+# Compute the total and band powers of the windows from segment periodograms shared between overlapping windows
+def segment_band_powers(data, window_size, step_size, n_windows, sampling_freq):
+    # Longest segment that tiles both the windows and the steps, with Welch's default half overlap
+    segment_size = gcd(window_size, step_size)
+    segment_step = segment_size // 2 if segment_size % 2 == 0 else segment_size
+    weights = band_power_weights(sampling_freq, segment_size)
+    
+    # Each band needs a few frequency bins to be integrated
+    freqs = np.fft.rfftfreq(segment_size, 1 / sampling_freq)
+    for band, (low, high) in BANDS.items():
+        if np.count_nonzero(np.logical_and(freqs >= low, freqs <= high)) < 2:
+            raise ValueError(
+                f"Segments of {segment_size} samples are too short to resolve the {band} band, "
+                f"use a time step that divides the window duration into longer segments."
+            )
+    
+    # Periodogram of every segment, computed once for the whole signal
+    n_used = (n_windows - 1) * step_size + window_size
+    _, _, sxx = spectrogram(
+        data[:, :n_used], fs=sampling_freq, window='hann', nperseg=segment_size,
+        noverlap=segment_size - segment_step, detrend='constant', scaling='density', mode='psd',
+    )
+    
+    # Band powers are linear in the PSD, so project each segment first and average the powers
+    segment_powers = np.swapaxes(sxx, -1, -2) @ weights
+    prefix = np.zeros((len(data), segment_powers.shape[1] + 1, len(BANDS) + 1))
+    np.cumsum(segment_powers, axis=1, out=prefix[:, 1:])
+    
+    # Running sum over the segments covered by each window
+    segments_per_window = (window_size - segment_size) // segment_step + 1
+    first_segments = np.arange(n_windows) * (step_size // segment_step)
+    return (prefix[:, first_segments + segments_per_window] - prefix[:, first_segments]) / segments_per_window
+
+# Assemble the feature DataFrame of the batched engine, with the same columns as moving_window
+def window_features_frame(moments, powers):
+    features = {
+        'Window_index': np.arange(1, len(moments) + 1),
+        'mean': moments[:, 0],
+        'variance': moments[:, 1],
+        'skewness': moments[:, 2],
+        'kurtosis': moments[:, 3],
+    }
+    total_power = powers[:, 0]
+    for column, band in enumerate(BANDS, start=1):
+        features[f"{band} abs power"] = powers[:, column]
+        features[f"{band} rel power"] = powers[:, column] / total_power
+    
+    # Ratio of delta power to beta power as an index of slow-wave sleep quality
+    delta_power = features['delta abs power']
+    beta_power = features['beta abs power']
+    with np.errstate(divide='ignore', invalid='ignore'):
+        features['slow-wave sleep quality'] = np.where(beta_power != 0, delta_power / beta_power, np.nan)
+    
+    return pd.DataFrame(features)
+
+# Save the features of a channel with the output backend, csv by default
+def save_features(channel_name, save_path, df, source=None, backend=None):
+            backend = backend or CsvBackend()
+            with stage("write", channel=channel_name):
+                return backend.write(df, save_path, source, channel_name)
+
+# Compute the window features of a (channels, samples) array with the configured engine
+@timed("features")
+def compute_window_features(data, sampling_freq, config):
+    if config.eeg_engine == "loop":
+        # Create a DataFrame for each channel and go through the windows one at a time
+        return [
+            moving_window(pd.DataFrame({'amplitude': channel}), config.window_duration, config.time_step, sampling_freq)
+            for channel in data
+        ]
+    return moving_window_multichannel(
+        data, config.window_duration, config.time_step, sampling_freq, config.eeg_rolling_moments,
+        shared_segments=config.eeg_engine == "stft",
+    )
+
+# Get the largest decimation factor that keeps every band in the passband of the anti-alias filter
+def decimation_factor(sampling_freq, window_duration, time_step):
+    highest_freq = max(high for _, high in BANDS.values())
+    window_size = int(sampling_freq * window_duration)
+    step_size = int(sampling_freq * time_step)
+    
+    for factor in range(int(sampling_freq // highest_freq), 1, -1):
+        # Leave at least 20% of the new Nyquist frequency for the filter transition band
+        if 0.4 * sampling_freq / factor < highest_freq:
+            continue
+        # Windows and steps must stay on whole samples at the new rate
+        if window_size % factor == 0 and step_size % factor == 0:
+            return factor
+    return 1
+
+# Design the anti-alias FIR filter, flat up to the highest band and stopping at the new Nyquist frequency
+@lru_cache(maxsize=None)
+def anti_alias_filter(sampling_freq, factor, attenuation=80):
+    highest_freq = max(high for _, high in BANDS.values())
+    new_nyquist = sampling_freq / factor / 2
+    # Kaiser window design, the passband ripple is as small as the stopband gain (1e-4 for 80 dB)
+    numtaps, beta = kaiserord(attenuation, (new_nyquist - highest_freq) / (sampling_freq / 2))
+    numtaps += 1 - numtaps % 2  # Odd length for a symmetric filter centered on a sample
+    return firwin(numtaps, (highest_freq + new_nyquist) / 2, window=('kaiser', beta), fs=sampling_freq)
+
+# Read samples [start, stop) of the channels, decimated by factor
+def read_channels(raw, channel_names, start, stop, factor, pad=0):
+    if factor == 1:
+        with stage("load", start=start, stop=stop):
+            return raw.get_data(picks=channel_names, start=start, stop=stop)
+    
+    # Read some context around the block so the filter has no edge effects inside it
+    read_start = max(0, start - pad)
+    read_stop = min(raw.n_times, stop + pad)
+    with stage("load", start=read_start, stop=read_stop):
+        data = raw.get_data(picks=channel_names, start=read_start, stop=read_stop)
+    # Linear-phase filter with its delay compensated, so zero-phase, then keep every factor-th sample
+    with stage("filter", factor=factor):
+        window = anti_alias_filter(raw.info['sfreq'], factor)
+        data = resample_poly(data, 1, factor, axis=-1, window=window, padtype='edge')
     
-def extract_eeg_features(file_path, save_path, config):
-    #Load the EDF file
-    raw = mne.io.read_raw_edf(file_path, preload=True)
+    # Keep the decimated samples of the block, aligned to the same grid as the whole recording
+    first = (start - read_start) // factor
+    return data[:, first:first + -(-(stop - start) // factor)]
+
+# Save the recording metadata next to the features, as <name>_metadata.json
+def save_metadata(name, save_path, metadata):
+    json_path = os.path.join(save_path, f"{name}_metadata.json")
+    # A recording of a subfolder of the data path (e.g. night1/rec) is saved in the same subfolder
+    os.makedirs(os.path.dirname(json_path), exist_ok=True)
+    with open(json_path, 'w') as file:
+        json.dump(metadata, file, indent=2)
+    return json_path
+
+# Read the EDF in blocks and yield the window features of each block (one DataFrame per channel) as soon as they are computed
+def stream_window_features(raw, channel_names, config, factor=1):
+    sampling_freq = raw.info['sfreq'] / factor
+    window_size = int(sampling_freq * config.window_duration)
+    step_size = int(sampling_freq * config.time_step)
+    block_size = int(sampling_freq * config.eeg_block_duration)
+    if block_size < window_size:
+        raise ValueError(f"The block duration {config.eeg_block_duration} s must be at least the window duration {config.window_duration} s.")
     
-    channel_names = raw.info['ch_names']
+    # About one second of context on each side of a block for the decimation filter, on the decimation grid
+    pad = factor * int(np.ceil(raw.info['sfreq'] / factor)) if factor > 1 else 0
+    
+    # Samples read but not yet covered by all their windows, carried over to the next block
+    buffer = np.empty((len(channel_names), 0))
+    next_sample = 0
+    n_previous = 0
+    
+    while next_sample < raw.n_times:
+        # Top the buffer up to a full block
+        stop = min(next_sample + (block_size - buffer.shape[1]) * factor, raw.n_times)
+        block = read_channels(raw, channel_names, next_sample, stop, factor, pad)
+        buffer = np.concatenate((buffer, block), axis=1)
+        n_buffered = buffer.shape[1]
+        next_sample = stop
+        
+        feature_dfs = compute_window_features(buffer, sampling_freq, config)
+        n_windows = len(feature_dfs[0])
+        if n_windows == 0:
+            continue
+        
+        for feature_df in feature_dfs:
+            # Number the windows from the start of the recording
+            feature_df['Window_index'] += n_previous
+        n_previous += n_windows
         
-    for channel_name in channel_names:
-        if 'eeg' in channel_name.lower():
-            channel = raw.copy().pick_channels([channel_name])
-            #Select the channel
-            data, times = channel[:]
-            sampling_freq = raw.info['sfreq']
-            
-            #Create a DataFrame for the channel data
-            channel_df = pd.DataFrame({'time': times, 'amplitude': data[0]})
-            feature_df = moving_window(channel_df, config.window_duration, config.time_step, sampling_freq)
-            
-            # Save the csv
-            save_features(channel_name, save_path, feature_df)
+        # Keep the overlap needed by the windows that start in this block but end in the next one
+        next_start = n_windows * step_size
+        buffer = buffer[:, next_start:].copy()
+        # With a step longer than a window the next window starts past the buffer, skip the samples up to it
+        next_sample += max(0, next_start - n_buffered) * factor
+        yield feature_dfs
+
+# Read the EDF in blocks and write the features of each block as soon as they are computed
+def extract_eeg_features_streaming(raw, channel_names, save_path, config, factor=1, source=None):
+    # The rows of each channel are written block by block
+    backend = get_backend(config)
+    writers = [backend.writer(save_path, source, channel_name) for channel_name in channel_names]
+    
+    for feature_dfs in stream_window_features(raw, channel_names, config, factor):
+        for channel_name, writer, feature_df in zip(channel_names, writers, feature_dfs):
+            with stage("write", channel=channel_name):
+                writer.write(feature_df)
     
-            
-            
+    # A recording shorter than a window gets the same empty tables as the in-memory path
+    return [writer.close() for writer in writers]
+    
+# Open the EDF file, the samples are only read when requested, and get its EEG channels
+@timed("open")
+def open_eeg(file_path):
+    raw = mne.io.read_raw_edf(file_path, preload=False)
+    channel_names = [channel_name for channel_name in raw.info['ch_names'] if 'eeg' in channel_name.lower()]
+    return raw, channel_names
 
+# The features are saved under name (the source of the partitioned outputs), the file name without its extension by default
+def extract_eeg_features(file_path, save_path, config, name=None):
+    raw, channel_names = open_eeg(file_path)
+    sampling_freq = raw.info['sfreq']
+    if not channel_names:
+        return []
+    
+    # Name of the recording in the partitioned outputs
+    source = name or os.path.splitext(os.path.basename(file_path))[0]
+    
+    # Downsample to the lowest rate that still holds all the bands, the rate the features were computed at is
+    # saved next to them since it differs from the rate of the EDF
+    factor = 1
+    output_paths = []
+    if config.eeg_decimate:
+        factor = decimation_factor(sampling_freq, config.window_duration, config.time_step)
+        output_paths.append(save_metadata(source, save_path, {
+            'source': source + os.path.splitext(file_path)[1],
+            'channels': channel_names,
+            'sampling_freq': sampling_freq,
+            'decimation_factor': factor,
+            'effective_sampling_freq': sampling_freq / factor,
+        }))
+    
+    # Long recordings are processed one block at a time to bound the memory use
+    if config.eeg_block_duration is not None:
+        return output_paths + extract_eeg_features_streaming(raw, channel_names, save_path, config, factor, source)
+    
+    # Read all the EEG channels at once into a (channels, samples) array
+    data = read_channels(raw, channel_names, 0, raw.n_times, factor)
+    feature_dfs = compute_window_features(data, sampling_freq / factor, config)
+    
+    # Save the features of each channel
+    backend = get_backend(config)
+    return output_paths + [
+        save_features(channel_name, save_path, feature_df, source, backend)
+        for channel_name, feature_df in zip(channel_names, feature_dfs)
+    ]
 
+# Stack the feature DataFrames of the channels into a (windows, channels, features) array and name its features
+def window_feature_array(feature_dfs):
+    feature_dfs = [feature_df.drop(columns='Window_index', errors='ignore') for feature_df in feature_dfs]
+    return list(feature_dfs[0].columns), np.stack([feature_df.to_numpy(dtype=float) for feature_df in feature_dfs], axis=1)
 
+# Window features of the EEG channels of a recording as one array, for the tensor export
+# Returns None if the recording has no EEG channel
+def extract_eeg_tensor(file_path, config):
+    raw, channel_names = open_eeg(file_path)
+    sampling_freq = raw.info['sfreq']
+    if not channel_names:
+        return None
+    
+    factor = decimation_factor(sampling_freq, config.window_duration, config.time_step) if config.eeg_decimate else 1
+    if config.eeg_block_duration is not None:
+        blocks = [window_feature_array(feature_dfs) for feature_dfs in stream_window_features(raw, channel_names, config, factor)]
+    else:
+        data = read_channels(raw, channel_names, 0, raw.n_times, factor)
+        blocks = [window_feature_array(compute_window_features(data, sampling_freq / factor, config))]
+    
+    # A recording shorter than a window has no rows
+    blocks = [(names, values) for names, values in blocks if len(values)]
+    names = blocks[0][0] if blocks else []
+    values = np.concatenate([values for _, values in blocks]) if blocks else np.empty((0, len(channel_names), 0))
+    return {
+        "values": values,
+        "coords": {"channels": channel_names, "features": names},
+        "sampling_freq": sampling_freq,
+        "decimation_factor": factor,
+    }
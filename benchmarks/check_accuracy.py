@@ -0,0 +1,114 @@
+import argparse
+import json
+import os
+import sys
+import warnings
+import numpy as np
+
+# Run from the repository root or from anywhere else
+REPO_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if REPO_PATH not in sys.path:
+    sys.path.insert(0, REPO_PATH)
+
+from config import Config
+from Signal_Processing import EEG_processing as eeg
+from Audio import Audio_processing as audio
+from benchmarks.fixtures import synthetic_snore
+
+
+# Largest relative difference allowed between two engines that compute the same features
+RELATIVE_TOLERANCE = 1e-6
+
+# Largest median relative difference of each audio feature at the native rate from the feature at config.sr,
+# the content above the reduced Nyquist frequency is dropped so they are not equal
+NATIVE_RATE_TOLERANCE = {
+    "rms": 0.01,
+    "spectral_centroid": 0.02,
+    "spectral_bandwidth": 0.05,
+    "spectral_rolloff": 0.02,
+    "zcr": 0.05,
+}
+
+
+# Largest difference of b from a relative to a, over the values both have, and whether both have NaN at the same places
+def compare(a, b):
+    same_nan = bool(np.array_equal(np.isnan(a), np.isnan(b)))
+    both = ~np.isnan(a) & ~np.isnan(b)
+    error = np.abs(b[both] - a[both]) / np.maximum(np.abs(a[both]), 1.0)
+    return same_nan, float(error.max()) if error.size else 0.0
+
+# Rolling moments against the batched engine on EEG with a flat zero dropout, a constant stretch and a large DC offset,
+# the constant windows must have NaN skewness and kurtosis like in the batched engine and scipy
+def check_rolling_moments():
+    rng = np.random.default_rng(0)
+    sampling_freq = 256
+    n_samples = 120 * sampling_freq
+    data = 40 + 3 * np.cumsum(rng.normal(size=(3, n_samples)), axis=1)
+    data[0, 10 * sampling_freq:70 * sampling_freq] = 0
+    data[1, 20 * sampling_freq:90 * sampling_freq] = 12.5
+    data[2] += 1e4
+    data[2, 50 * sampling_freq:80 * sampling_freq] = 1e4
+
+    window_size, step_size = 4 * sampling_freq, sampling_freq
+    n_windows = (n_samples - window_size) // step_size + 1
+    rolling = eeg.rolling_time_domain_features(data, window_size, step_size, n_windows)
+    with warnings.catch_warnings():
+        # scipy warns about the precision of the constant windows it gives NaN for
+        warnings.simplefilter("ignore", RuntimeWarning)
+        batched = eeg.batched_time_domain_features(data, window_size, step_size, n_windows)
+
+    same_nan, error = compare(batched, rolling)
+    return {
+        "constant_windows": int(np.isnan(batched[..., 2]).sum()),
+        "same_nan": same_nan,
+        "max_relative_error": error,
+        "passed": same_nan and error <= RELATIVE_TOLERANCE,
+    }
+
+# Audio features at the native rate against those at config.sr on 44.1 kHz snore clips with broadband noise,
+# which has content up to 22 kHz. The native rate computes no MFCCs, the other features must stay within tolerance
+def check_audio_native_rate():
+    rng = np.random.default_rng(0)
+    sampling_freq = 44100
+    clips = [synthetic_snore(10.0, sampling_freq, rng) + 0.05 * rng.normal(size=10 * sampling_freq) for _ in range(4)]
+
+    features = {}
+    for native_rate in (False, True):
+        plan = audio.AudioFeaturePlan(Config(30, 15, 0.5, 40, 100, 4000, sampling_freq, 512, audio_native_rate=native_rate))
+        features[native_rate] = [audio.compute_features(audio.filter_audio(y, sampling_freq, plan), plan) for y in clips]
+
+    result = {"factor": plan.factor, "native_mfccs": int(features[True][0][2].shape[0]), "median_relative_error": {}}
+    passed = result["factor"] > 1 and result["native_mfccs"] == 0
+    for name, tolerance in NATIVE_RATE_TOLERANCE.items():
+        full = np.concatenate([columns[name] for _, columns, _, _ in features[False]])
+        native = np.concatenate([columns[name] for _, columns, _, _ in features[True]])
+        error = float(np.median(np.abs(native - full) / np.maximum(np.abs(full), 1e-12)))
+        result["median_relative_error"][name] = error
+        passed = passed and error <= tolerance
+    result["passed"] = passed
+    return result
+
+
+# Checks that can be run, by name
+CHECKS = {
+    "rolling_moments": check_rolling_moments,
+    "audio_native_rate": check_audio_native_rate,
+}
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Check that the optimized feature engines agree with the reference ones on synthetic inputs.")
+    parser.add_argument("checks", nargs="*", metavar="CHECK", help=f"checks to run: {', '.join(CHECKS)} (default: all)")
+    args = parser.parse_args(argv)
+    unknown = [name for name in args.checks if name not in CHECKS]
+    if unknown:
+        parser.error(f"unknown checks: {', '.join(unknown)}")
+
+    results = {name: CHECKS[name]() for name in args.checks or CHECKS}
+    json.dump(results, sys.stdout, indent=2)
+    print()
+    # Exit code 1 if a check failed
+    return 0 if all(result["passed"] for result in results.values()) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,151 @@
+import os
+import numpy as np
+import soundfile as sf
+import wfdb
+from scipy.signal import lfilter
+
+
+# Frequency of the tone added to each EEG channel, one band per channel in turn (see EEG_processing.BANDS)
+EEG_TONES = [2.0, 6.0, 10.0, 20.0, 40.0]
+
+# Waves of the synthetic heart beat: (offset from the R peak in s, amplitude in mV, width in s)
+PQRST_WAVES = {
+    "P": (-0.2, 0.15, 0.025),
+    "Q": (-0.03, -0.1, 0.01),
+    "R": (0.0, 1.0, 0.012),
+    "S": (0.03, -0.25, 0.01),
+    "T": (0.3, 0.3, 0.04),
+}
+
+# Audio formats of the clips, by extension, with the subtype soundfile writes them in
+AUDIO_FORMATS = {
+    "wav": "PCM_16",
+    "flac": "PCM_16",
+    "ogg": "VORBIS",
+    "mp3": "MPEG_LAYER_III",
+}
+
+
+# Left aligned ASCII field of a fixed width, as in the EDF header
+def edf_field(value, width):
+    text = str(value)
+    if len(text) > width:
+        raise ValueError(f"EDF header value {text} does not fit in {width} characters.")
+    return text.ljust(width).encode("ascii")
+
+# Write a (channels, samples) array in microvolts to an EDF file with 16-bit samples and 1 s data records
+def write_edf(file_path, data, sampling_freq, channel_names, physical_range=500.0):
+    n_channels, n_samples = data.shape
+    samples_per_record = int(sampling_freq)
+    if samples_per_record != sampling_freq:
+        raise ValueError("The sampling frequency must be a whole number of samples per second.")
+    n_records = -(-n_samples // samples_per_record)
+
+    # Scale to the digital range, the last record is zero padded
+    digital = np.zeros((n_channels, n_records * samples_per_record))
+    digital[:, :n_samples] = np.clip(data / physical_range, -1, 1) * 32767
+    digital = np.round(digital).astype("<i2")
+
+    header = b"".join([
+        edf_field(0, 8),
+        edf_field("X X X synthetic", 80),
+        edf_field("Startdate 01-JAN-2024 X benchmark X", 80),
+        edf_field("01.01.24", 8),
+        edf_field("00.00.00", 8),
+        edf_field(256 * (n_channels + 1), 8),
+        edf_field("", 44),
+        edf_field(n_records, 8),
+        edf_field(1, 8),
+        edf_field(n_channels, 4),
+    ])
+    signal_fields = [
+        (channel_names, 16),
+        (["AgAgCl electrode"] * n_channels, 80),
+        (["uV"] * n_channels, 8),
+        ([-physical_range] * n_channels, 8),
+        ([physical_range] * n_channels, 8),
+        ([-32767] * n_channels, 8),
+        ([32767] * n_channels, 8),
+        (["HP:0.1Hz LP:100Hz"] * n_channels, 80),
+        ([samples_per_record] * n_channels, 8),
+        ([""] * n_channels, 32),
+    ]
+    # Each field of the header is given for all the signals before the next field
+    header += b"".join(edf_field(value, width) for values, width in signal_fields for value in values)
+
+    with open(file_path, "wb") as file:
+        file.write(header)
+        # Each data record holds one second of every signal, one signal after the other
+        file.write(digital.reshape(n_channels, n_records, samples_per_record).transpose(1, 0, 2).tobytes())
+    return file_path
+
+# Multi-channel EEG with one tone per channel, in a different band each, over red noise
+def make_eeg_fixture(folder, duration, n_channels=8, sampling_freq=512, seed=0):
+    rng = np.random.default_rng(seed)
+    t = np.arange(int(duration * sampling_freq)) / sampling_freq
+    noise = lfilter([1.0], [1.0, -0.95], rng.normal(size=(n_channels, len(t))), axis=1)
+    data = 5.0 * noise / np.std(noise, axis=1, keepdims=True)
+    for channel in range(n_channels):
+        data[channel] += 40.0 * np.sin(2 * np.pi * EEG_TONES[channel % len(EEG_TONES)] * t + channel)
+
+    channel_names = [f"EEG Ch{channel + 1}" for channel in range(n_channels)]
+    file_path = os.path.join(folder, f"eeg_{int(duration)}s.edf")
+    return write_edf(file_path, data, sampling_freq, channel_names)
+
+# Train of PQRST beats around 70 bpm with some heart rate variability, baseline wander and noise, in mV
+def synthetic_ecg(duration, sampling_freq, rng):
+    n_samples = int(duration * sampling_freq)
+    t = np.arange(n_samples) / sampling_freq
+
+    # Beat times, the RR intervals follow a slow breathing modulation plus jitter
+    beats = [0.5]
+    while beats[-1] < duration:
+        beats.append(beats[-1] + 0.85 + 0.05 * np.sin(2 * np.pi * 0.25 * beats[-1]) + rng.normal(0, 0.02))
+    beats = np.array(beats[:-1])
+
+    signal = 0.1 * np.sin(2 * np.pi * 0.3 * t) + rng.normal(0, 0.02, n_samples)
+    for offset, amplitude, width in PQRST_WAVES.values():
+        centers = beats + offset
+        # Only the samples within 5 widths of a wave are computed
+        reach = int(5 * width * sampling_freq)
+        for center in centers:
+            first = max(0, int(center * sampling_freq) - reach)
+            last = min(n_samples, int(center * sampling_freq) + reach)
+            signal[first:last] += amplitude * np.exp(-0.5 * ((t[first:last] - center) / width) ** 2)
+    return signal, beats
+
+# WFDB record (.dat and .hea) of two ECG leads
+def make_ecg_fixture(folder, duration, sampling_freq=360, seed=0):
+    rng = np.random.default_rng(seed)
+    lead_1, beats = synthetic_ecg(duration, sampling_freq, rng)
+    lead_2 = 0.6 * lead_1 + rng.normal(0, 0.02, len(lead_1))
+
+    record_name = f"ecg_{int(duration)}s"
+    wfdb.wrsamp(
+        record_name, fs=sampling_freq, units=["mV", "mV"], sig_name=["I", "II"],
+        p_signal=np.column_stack((lead_1, lead_2)), fmt=["16", "16"], write_dir=folder,
+    )
+    return os.path.join(folder, f"{record_name}.dat")
+
+# Snore-like clip: low-passed noise and a harmonic buzz in bursts at a breathing rate
+def synthetic_snore(duration, sampling_freq, rng):
+    t = np.arange(int(duration * sampling_freq)) / sampling_freq
+    breathing = np.clip(np.sin(2 * np.pi * 0.25 * t + rng.uniform(0, 2 * np.pi)), 0, None) ** 2
+    pitch = rng.uniform(80, 140)
+    buzz = sum(np.sin(2 * np.pi * pitch * k * t) / k for k in range(1, 6))
+    noise = np.convolve(rng.normal(size=len(t)), np.ones(8) / 8, mode="same")
+    return (0.3 * breathing * (buzz + 2.0 * noise) + 0.005 * rng.normal(size=len(t))).astype(np.float32)
+
+# 10 s clips in each of the audio formats soundfile can write here, n_clips per format
+def make_audio_fixtures(folder, n_clips, duration=10.0, sampling_freq=44100, formats=None, seed=0):
+    rng = np.random.default_rng(seed)
+    formats = formats or [extension for extension, subtype in AUDIO_FORMATS.items() if sf.check_format(extension.upper(), subtype)]
+
+    file_paths = {}
+    for extension in formats:
+        file_paths[extension] = []
+        for clip in range(n_clips):
+            file_path = os.path.join(folder, f"clip_{clip}.{extension}")
+            sf.write(file_path, synthetic_snore(duration, sampling_freq, rng), sampling_freq, subtype=AUDIO_FORMATS[extension])
+            file_paths[extension].append(file_path)
+    return file_paths
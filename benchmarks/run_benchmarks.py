@@ -0,0 +1,302 @@
+import argparse
+import contextlib
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+import tracemalloc
+import numpy as np
+import pandas as pd
+import scipy
+import mne
+import wfdb
+from scipy.signal import resample_poly
+
+# Run from the repository root or from anywhere else
+REPO_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if REPO_PATH not in sys.path:
+    sys.path.insert(0, REPO_PATH)
+
+from config import Config
+from output_backend import get_backend
+from Signal_Processing import EEG_processing as eeg
+from Signal_Processing import ECG_processing as ecg
+from Audio import Audio_processing as audio
+from benchmarks.fixtures import make_eeg_fixture, make_ecg_fixture, make_audio_fixtures
+
+
+# Input sizes of each modality: recording durations in seconds for EEG and ECG, number of 10 s clips per format for audio
+DEFAULT_SIZES = {
+    "eeg": [600, 3600],
+    "ecg": [300, 1800],
+    "audio": [1, 8],
+}
+
+# Parameters of the benchmark runs, any of them can be changed with --set name=value
+DEFAULT_PARAMETERS = {
+    "window_duration": 30,
+    "time_step": 15,
+    "ecg_low_cutoff": 0.5,
+    "ecg_high_cutoff": 40,
+    "audio_low_cutoff": 100,
+    "audio_high_cutoff": 4000,
+    "sr": 22050,
+    "hop_length": 512,
+}
+
+
+# Time a stage: the best of repeat runs, then one more run under tracemalloc for the peak memory it allocates
+# samples is the number of input samples, so the throughput of every stage of a file is comparable
+def measure(stage, function, samples, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function()
+        times.append(time.perf_counter() - start)
+
+    tracemalloc.start()
+    try:
+        function()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    seconds = min(times)
+    samples_per_s = samples / seconds if seconds > 0 else None
+    print(f"  {stage}: {seconds:.4f} s, {(samples_per_s or 0) / 1e6:.2f} M samples/s, peak {peak / 2**20:.1f} MiB", file=sys.stderr)
+    return result, {
+        "stage": stage,
+        "seconds": seconds,
+        "samples": int(samples),
+        "samples_per_s": samples_per_s,
+        "peak_bytes": peak,
+    }
+
+# Benchmark the stages of the EEG features of an EDF file
+def benchmark_eeg(file_path, config, save_path, repeat):
+    raw, channel_names = eeg.open_eeg(file_path)
+    sampling_freq = raw.info['sfreq']
+    samples = len(channel_names) * raw.n_times
+    source = os.path.splitext(os.path.basename(file_path))[0]
+    backend = get_backend(config)
+    stages = []
+
+    data, result = measure("load", lambda: eeg.read_channels(raw, channel_names, 0, raw.n_times, 1), samples, repeat)
+    stages.append(result)
+
+    # Anti-alias filter and decimation, only when the recording has room above the highest band
+    factor = eeg.decimation_factor(sampling_freq, config.window_duration, config.time_step)
+    if factor > 1:
+        window = eeg.anti_alias_filter(sampling_freq, factor)
+        decimated, result = measure(
+            "filter", lambda: resample_poly(data, 1, factor, axis=-1, window=window, padtype='edge'), samples, repeat
+        )
+        stages.append(result)
+        if config.eeg_decimate:
+            data, sampling_freq = decimated, sampling_freq / factor
+
+    # Copy of every window, the framing the loop engine goes through
+    window_size = int(sampling_freq * config.window_duration)
+    step_size = int(sampling_freq * config.time_step)
+    n_windows = (data.shape[1] - window_size) // step_size + 1 if data.shape[1] >= window_size else 0
+    _, result = measure(
+        "window", lambda: np.ascontiguousarray(eeg.window_view(data, window_size, step_size, n_windows)), samples, repeat
+    )
+    stages.append(result)
+
+    feature_dfs, result = measure("features", lambda: eeg.compute_window_features(data, sampling_freq, config), samples, repeat)
+    stages.append(result)
+
+    _, result = measure("write", lambda: [
+        eeg.save_features(channel_name, save_path, feature_df, source, backend)
+        for channel_name, feature_df in zip(channel_names, feature_dfs)
+    ], samples, repeat)
+    stages.append(result)
+
+    _, result = measure("total", lambda: eeg.extract_eeg_features(file_path, save_path, config), samples, repeat)
+    stages.append(result)
+    return stages
+
+# Benchmark the stages of the ECG features of a WFDB record
+def benchmark_ecg(file_path, config, save_path, repeat):
+    source = os.path.splitext(os.path.basename(file_path))[0]
+    backend = get_backend(config)
+    stages = []
+
+    (fs, signal), result = measure("load", lambda: ecg.read_signal(file_path), signal_size(file_path), repeat)
+    samples = signal.size
+    stages.append(result)
+
+    # The record is filtered in place, each run filters a fresh copy of it so the later stages get a single pass
+    smoothed_signal, result = measure(
+        "filter", lambda: ecg.smoothing_singal(signal.copy(), fs, config.ecg_low_cutoff, config.ecg_high_cutoff), samples, repeat
+    )
+    stages.append(result)
+
+    # R peaks and delineation of every beat
+    def delineate():
+        channels = []
+        for i in range(smoothed_signal.shape[1]):
+            channel_signal = smoothed_signal[:, i]
+            r_peaks = ecg.detect_r_peaks_streaming(channel_signal, fs) if config.ecg_r_peak_detector == "streaming" else None
+            features, r_peaks = ecg.extract_time_features(channel_signal, fs, r_peaks)[:2]
+            channels.append((features, r_peaks))
+        return channels
+    channels, result = measure("features", delineate, samples, repeat)
+    stages.append(result)
+
+    # HRV features over the windows
+    hrv_dfs, result = measure("window", lambda: [
+        ecg.extract_hrv_features(r_peaks, fs, config.window_duration, config.time_step, len(smoothed_signal))
+        for _, r_peaks in channels
+    ], samples, repeat)
+    stages.append(result)
+
+    def write():
+        output_paths = []
+        for i, ((features, _), hrv_df) in enumerate(zip(channels, hrv_dfs)):
+            output_paths.append(ecg.save_features(i+1, save_path, pd.DataFrame(features), source, backend))
+            output_paths.append(ecg.save_features(i+1, save_path, hrv_df, source, backend, table="hrv"))
+        return output_paths
+    _, result = measure("write", write, samples, repeat)
+    stages.append(result)
+
+    _, result = measure("total", lambda: ecg.extract_ecg_features(file_path, save_path, config), samples, repeat)
+    stages.append(result)
+    return stages
+
+# Number of samples of a WFDB record, all signals
+def signal_size(file_path):
+    header = wfdb.rdheader(ecg.get_record_path(file_path))
+    return header.n_sig * header.sig_len
+
+# Benchmark the stages of the audio features of clips, one clip at a time as extract_audio_features does
+def benchmark_audio(file_paths, config, save_path, repeat):
+    plan = audio.AudioFeaturePlan(config)
+    stages = []
+
+    # Decoded samples of the clips, the input of every stage
+    samples = sum(len(audio.prepare_audio(file_path, plan)[0]) for file_path in file_paths)
+    clips, result = measure("load", lambda: [audio.prepare_audio(file_path, plan) for file_path in file_paths], samples, repeat)
+    stages.append(result)
+
+    filtered, result = measure("filter", lambda: [audio.filter_audio(y, sr, plan) for y, sr in clips], samples, repeat)
+    stages.append(result)
+
+    # Copy of every STFT frame, the framing the features are computed on
+    _, result = measure("window", lambda: [
+        np.ascontiguousarray(audio.frame_audio(y, plan.n_fft, plan.hop_length)) for y in filtered
+    ], samples, repeat)
+    stages.append(result)
+
+    features, result = measure("features", lambda: [audio.compute_features(y, plan) for y in filtered], samples, repeat)
+    stages.append(result)
+
+    _, result = measure("write", lambda: [
+        audio.save_features(
+            os.path.splitext(os.path.basename(file_path))[0], save_path,
+            audio.features_frame(*clip_features, drop=plan.config.gate_drop), plan.backend,
+        )
+        for file_path, clip_features in zip(file_paths, features)
+    ], samples, repeat)
+    stages.append(result)
+
+    _, result = measure("total", lambda: [
+        audio.extract_audio_features(file_path, save_path, config, plan) for file_path in file_paths
+    ], samples, repeat)
+    stages.append(result)
+    return stages
+
+# Parse a --set value as JSON (numbers, booleans, null), or keep it as a string
+def parse_value(value):
+    try:
+        return json.loads(value)
+    except json.JSONDecodeError:
+        return value
+
+# Versions and machine the results were measured on
+def environment():
+    return {
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "scipy": scipy.__version__,
+        "mne": mne.__version__,
+        "platform": platform.platform(),
+        "processor": platform.processor(),
+        "cpu_count": os.cpu_count(),
+    }
+
+# Clips of a fixture folder by format
+def group_by_format(folder):
+    file_paths = {}
+    for file in sorted(os.listdir(folder)):
+        file_paths.setdefault(os.path.splitext(file)[1][1:], []).append(os.path.join(folder, file))
+    return file_paths
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Time each stage of the EEG, ECG and audio feature extraction on synthetic inputs.")
+    parser.add_argument("--modalities", nargs="+", choices=list(DEFAULT_SIZES), default=list(DEFAULT_SIZES))
+    parser.add_argument("--eeg-durations", nargs="+", type=float, default=DEFAULT_SIZES["eeg"], help="EDF durations in seconds")
+    parser.add_argument("--ecg-durations", nargs="+", type=float, default=DEFAULT_SIZES["ecg"], help="WFDB record durations in seconds")
+    parser.add_argument("--audio-clips", nargs="+", type=int, default=DEFAULT_SIZES["audio"], help="number of 10 s clips per format")
+    parser.add_argument("--repeat", type=int, default=3, help="runs of each stage, the best time is reported")
+    parser.add_argument("--set", action="append", default=[], metavar="NAME=VALUE", help="Config parameter of the runs, e.g. eeg_engine=stft")
+    parser.add_argument("--fixtures", help="folder to keep the generated inputs in, reused when they exist (default: a temporary folder)")
+    parser.add_argument("--output", help="JSON file to write the results to (default: standard output)")
+    args = parser.parse_args(argv)
+
+    parameters = dict(DEFAULT_PARAMETERS)
+    for assignment in args.set:
+        name, _, value = assignment.partition("=")
+        parameters[name] = parse_value(value)
+    config = Config(**parameters)
+    mne.set_log_level("WARNING")
+
+    results = []
+    # The extraction prints its tables, only the progress goes to the standard error
+    with tempfile.TemporaryDirectory() as temp_path, open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        fixture_path = args.fixtures or os.path.join(temp_path, "fixtures")
+        save_path = os.path.join(temp_path, "features")
+        os.makedirs(fixture_path, exist_ok=True)
+        os.makedirs(save_path, exist_ok=True)
+
+        cases = []
+        if "eeg" in args.modalities:
+            for duration in args.eeg_durations:
+                file_path = os.path.join(fixture_path, f"eeg_{int(duration)}s.edf")
+                if not os.path.exists(file_path):
+                    make_eeg_fixture(fixture_path, duration)
+                cases.append(("eeg", os.path.basename(file_path), duration, benchmark_eeg, file_path))
+        if "ecg" in args.modalities:
+            for duration in args.ecg_durations:
+                file_path = os.path.join(fixture_path, f"ecg_{int(duration)}s.dat")
+                if not os.path.exists(file_path):
+                    make_ecg_fixture(fixture_path, duration)
+                cases.append(("ecg", os.path.basename(file_path), duration, benchmark_ecg, file_path))
+        if "audio" in args.modalities:
+            for n_clips in args.audio_clips:
+                # Each size has its own folder, the clips are named after their index
+                clip_path = os.path.join(fixture_path, f"audio_{n_clips}")
+                os.makedirs(clip_path, exist_ok=True)
+                file_paths = make_audio_fixtures(clip_path, n_clips) if not os.listdir(clip_path) else group_by_format(clip_path)
+                for extension, format_paths in file_paths.items():
+                    cases.append(("audio", extension, n_clips, benchmark_audio, format_paths))
+
+        for modality, name, size, benchmark, inputs in cases:
+            print(f"{modality} {name} ({size})", file=sys.stderr)
+            for stage in benchmark(inputs, config, save_path, args.repeat):
+                results.append({"modality": modality, "input": name, "size": size, **stage})
+
+    report = {"environment": environment(), "parameters": parameters, "repeat": args.repeat, "results": results}
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(report, file, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+
+
+if __name__ == "__main__":
+    main()
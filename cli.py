@@ -0,0 +1,250 @@
+import os
+
+# Draw any figure off screen, batch runs have no display
+os.environ.setdefault("MPLBACKEND", "Agg")
+
+import argparse
+import contextlib
+import inspect
+import json
+import sys
+from config import Config
+from data_loader import DataLoader
+from output_backend import BACKENDS
+import instrumentation
+
+
+# Types of the Config parameters that have no default, or None as default
+CONFIG_TYPES = {
+    "window_duration": float,
+    "time_step": float,
+    "ecg_low_cutoff": float,
+    "ecg_high_cutoff": float,
+    "audio_low_cutoff": float,
+    "audio_high_cutoff": float,
+    "sr": int,
+    "hop_length": int,
+    "eeg_block_duration": float,
+    "ecg_segment_duration": float,
+    "audio_cache_dir": str,
+    "audio_gate_threshold": float,
+}
+
+# Values accepted by the Config parameters that select an implementation
+CONFIG_CHOICES = {
+    "eeg_engine": ["batched", "loop", "stft"],
+    "ecg_r_peak_detector": ["threshold", "streaming"],
+    "output_format": list(BACKENDS),
+}
+
+# DataLoader options a job can set (--workers, --force, --recursive, --include and --exclude on the command line)
+LOADER_OPTIONS = ["n_workers", "force", "recursive", "include", "exclude"]
+
+# Exit codes: every file was loaded (or skipped), some file or job failed, the job spec or options are invalid
+EXIT_OK = 0
+EXIT_FAILED = 1
+EXIT_USAGE = 2
+
+
+# Parameters of Config with their defaults, inspect.Parameter.empty for the required ones
+def config_parameters():
+    parameters = inspect.signature(Config.__init__).parameters
+    return {name: parameter.default for name, parameter in parameters.items() if name != "self"}
+
+# Build the argument parser, with one option per Config parameter
+def build_parser():
+    parser = argparse.ArgumentParser(
+        description="Extract the EEG, ECG and audio features of a folder without the UI, or run the jobs of a job spec.",
+    )
+    parser.add_argument("data_path", nargs="?", help="folder of the files to extract")
+    parser.add_argument("save_path", nargs="?", help="folder the features are saved to")
+    parser.add_argument("--job", help="JSON or YAML job spec: a list of jobs, or {\"defaults\": {...}, \"jobs\": [...]}")
+    parser.add_argument("--job-index", type=int, help="only run the job at this index of the spec (e.g. the array task id of a scheduler)")
+
+    # Options left out do not override the values of the job spec
+    config_group = parser.add_argument_group("Config parameters")
+    for name, default in config_parameters().items():
+        option = f"--{name.replace('_', '-')}"
+        if isinstance(default, bool):
+            config_group.add_argument(option, dest=name, action=argparse.BooleanOptionalAction, default=argparse.SUPPRESS,
+                                      help=f"(default: {default})")
+        else:
+            required = default is inspect.Parameter.empty
+            config_group.add_argument(option, dest=name, type=CONFIG_TYPES.get(name, type(default)), choices=CONFIG_CHOICES.get(name),
+                                      default=argparse.SUPPRESS, help="(required)" if required else f"(default: {default})")
+
+    loader_group = parser.add_argument_group("Loading")
+    loader_group.add_argument("--workers", dest="n_workers", type=int, default=argparse.SUPPRESS, help="number of worker processes (default: 1)")
+    loader_group.add_argument("--force", action="store_true", default=argparse.SUPPRESS, help="re-extract the files the manifest says are up to date")
+    loader_group.add_argument("--recursive", action="store_true", default=argparse.SUPPRESS, help="also load the files in the subfolders")
+    loader_group.add_argument("--include", action="append", default=argparse.SUPPRESS, metavar="GLOB",
+                              help="only load the files whose path relative to the data folder matches, can be repeated")
+    loader_group.add_argument("--exclude", action="append", default=argparse.SUPPRESS, metavar="GLOB",
+                              help="skip the files whose path relative to the data folder matches, can be repeated")
+
+    output_group = parser.add_argument_group("Output")
+    output_group.add_argument("--report", help="write the status of every file of every job to this JSON file")
+    output_group.add_argument("--timings", help="append the timings of the extraction stages to this JSON lines file")
+    output_group.add_argument("--trace-memory", action="store_true", help="also record the peak memory of each stage in the timings")
+    output_group.add_argument("--quiet", action="store_true", help="hide the output of the extraction, only print the summary")
+    output_group.add_argument("--dry-run", action="store_true", help="list the files each job would load and stop")
+    return parser
+
+# Read the jobs of a spec, the defaults are applied to every job
+# Relative folders are taken from the folder of the spec
+def load_job_spec(path):
+    with open(path) as file:
+        if path.lower().endswith((".yaml", ".yml")):
+            try:
+                import yaml
+            except ImportError:
+                raise ImportError("Reading a YAML job spec needs PyYAML, install it or use a JSON job spec.")
+            spec = yaml.safe_load(file)
+        else:
+            spec = json.load(file)
+
+    if isinstance(spec, list):
+        spec = {"jobs": spec}
+    if not isinstance(spec, dict) or not isinstance(spec.get("jobs"), list):
+        raise ValueError(f"The job spec {path} must be a list of jobs or have a list of jobs under \"jobs\".")
+
+    jobs = []
+    spec_folder = os.path.dirname(os.path.abspath(path))
+    for job in spec["jobs"]:
+        job = {**spec.get("defaults", {}), **job}
+        for key in ("data_path", "save_path"):
+            if key in job:
+                job[key] = os.path.normpath(os.path.join(spec_folder, os.path.expanduser(job[key])))
+        jobs.append(job)
+    return jobs
+
+# Check the settings of a job, raising ValueError for a missing or unknown one
+def check_job(job, index):
+    parameters = config_parameters()
+    known = set(parameters) | set(LOADER_OPTIONS) | {"name", "data_path", "save_path"}
+    unknown = sorted(set(job) - known)
+    if unknown:
+        raise ValueError(f"Job {index} has unknown settings: {', '.join(unknown)}.")
+
+    required = ["data_path", "save_path"] + [name for name, default in parameters.items() if default is inspect.Parameter.empty]
+    missing = [name for name in required if job.get(name) is None]
+    if missing:
+        raise ValueError(f"Job {index} is missing: {', '.join(missing)}.")
+    
+    for name, choices in CONFIG_CHOICES.items():
+        if name in job and job[name] not in choices:
+            raise ValueError(f"Job {index} has an invalid {name} {job[name]!r}, expected one of {', '.join(choices)}.")
+
+    # Patterns may be given as a single string
+    for key in ("include", "exclude"):
+        if isinstance(job.get(key), str):
+            job[key] = [job[key]]
+
+# Build the DataLoader of a job
+def make_loader(job):
+    config = Config(**{name: job[name] for name in config_parameters() if name in job})
+    options = {name: job[name] for name in LOADER_OPTIONS if name in job}
+    return DataLoader(job["data_path"], job["save_path"], config, **options)
+
+# Run a job and get the result of every file, the extraction output is hidden if quiet
+def run_job(job, quiet=False):
+    loader = make_loader(job)
+    if not quiet:
+        return loader.load_data()
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        return loader.load_data()
+
+# Print the summary of a job: the number of files by status, then the files that failed or are not supported
+def print_summary(name, job, results, error=None):
+    print(f"{name}: {job.get('data_path')} -> {job.get('save_path')}")
+    if error is not None:
+        print(f"  job failed: {error}")
+        return
+
+    counts = {}
+    for result in results:
+        counts[result["status"]] = counts.get(result["status"], 0) + 1
+    print("  " + (", ".join(f"{status} {count}" for status, count in sorted(counts.items())) or "no files"))
+    for result in results:
+        if result["status"] == "failed":
+            print(f"  failed       {result['file']}: {result['error']}")
+        elif result["status"] == "unsupported":
+            print(f"  unsupported  {result['file']}")
+
+def main(argv=None):
+    parser = build_parser()
+    args = vars(parser.parse_args(argv))
+
+    # Settings given on the command line, they override the ones of the job spec
+    overrides = {name: args[name] for name in list(config_parameters()) + list(LOADER_OPTIONS) if name in args}
+
+    try:
+        if args["job"] is not None:
+            if args["data_path"] is not None:
+                raise ValueError("The folders of the jobs are given by the job spec, not on the command line.")
+            jobs = load_job_spec(args["job"])
+            if args["job_index"] is not None:
+                if not 0 <= args["job_index"] < len(jobs):
+                    raise ValueError(f"Job index {args['job_index']} is out of range, the spec has {len(jobs)} jobs.")
+                jobs = [jobs[args["job_index"]]]
+            indices = [args["job_index"]] if args["job_index"] is not None else list(range(len(jobs)))
+        else:
+            jobs = [{"data_path": args["data_path"], "save_path": args["save_path"]}]
+            indices = [0]
+        for index, job in zip(indices, jobs):
+            job.update(overrides)
+            check_job(job, index)
+    except (OSError, ValueError, ImportError) as error:
+        parser.print_usage(sys.stderr)
+        print(f"{parser.prog}: error: {error}", file=sys.stderr)
+        return EXIT_USAGE
+
+    if args["dry_run"]:
+        exit_code = EXIT_OK
+        for index, job in zip(indices, jobs):
+            print(f"{job.get('name', f'Job {index}')}: {job['data_path']} -> {job['save_path']}")
+            try:
+                file_paths = make_loader(job).get_file_paths()
+            except Exception as error:
+                print(f"  job failed: {error!r}")
+                exit_code = EXIT_FAILED
+                continue
+            for file_path in file_paths:
+                print(f"  {file_path}")
+        return exit_code
+
+    if args["timings"]:
+        instrumentation.enable(instrumentation.JsonLinesSink(args["timings"]), trace_memory=args["trace_memory"])
+
+    report = []
+    exit_code = EXIT_OK
+    for index, job in zip(indices, jobs):
+        name = job.get("name", f"Job {index}")
+        entry = {"name": name, "index": index, "data_path": job["data_path"], "save_path": job["save_path"], "error": None, "files": []}
+        try:
+            with instrumentation.context(job=name):
+                results = run_job(job, args["quiet"])
+        except Exception as error:
+            # A job that cannot run (e.g. a missing data folder) does not stop the other jobs
+            print_summary(name, job, [], error=repr(error))
+            entry["error"] = repr(error)
+            exit_code = EXIT_FAILED
+        else:
+            print_summary(name, job, results)
+            entry["files"] = [
+                {"file": result["file"], "status": result["status"], "error": result["error"], "outputs": result["outputs"]}
+                for result in results
+            ]
+            if any(result["status"] == "failed" for result in results):
+                exit_code = EXIT_FAILED
+        report.append(entry)
+
+    instrumentation.disable()
+    if args["report"]:
+        with open(args["report"], "w") as file:
+            json.dump({"exit_code": exit_code, "jobs": report}, file, indent=2)
+    return exit_code
+
+
+if __name__ == "__main__":
+    sys.exit(main())
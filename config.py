@@ -1,13 +1,37 @@
 class  Config:
-    def __init__(self, window_duration, time_step, ecg_low_cutoff, ecg_high_cutoff, audio_low_cutoff, audio_high_cutoff, sr, hop_length):
+    def __init__(self, window_duration, time_step, ecg_low_cutoff, ecg_high_cutoff, audio_low_cutoff, audio_high_cutoff, sr, hop_length, eeg_engine="batched", eeg_rolling_moments=False, eeg_block_duration=None, eeg_decimate=False, ecg_segment_duration=None, ecg_r_peak_detector="threshold", ecg_hrv=False, audio_native_rate=False, audio_batch_size=1, audio_cache_dir=None, audio_cache_size=2 << 30, audio_gate_threshold=None, audio_gate_drop=False, audio_summary=False, output_format="csv", export_tensors=False):
         
         # EEG Features
         self.window_duration = window_duration
         self.time_step = time_step
+        # "batched" computes all the windows at once, "loop" goes one window at a time,
+        # "stft" averages segment periodograms shared between overlapping windows (Welch with shorter segments)
+        self.eeg_engine = eeg_engine
+        # Compute the time domain features of the batched engine from prefix sums
+        self.eeg_rolling_moments = eeg_rolling_moments
+        # Read the EDF in blocks of this many seconds instead of loading it all, None loads the whole file
+        self.eeg_block_duration = eeg_block_duration
+        # Low-pass and downsample the EEG to the lowest rate that keeps all the bands before windowing,
+        # the rate the features were computed at is saved to EEG/<recording>_metadata.json
+        self.eeg_decimate = eeg_decimate
         
         # ECG Features
         self.ecg_low_cutoff = ecg_low_cutoff
         self.ecg_high_cutoff = ecg_high_cutoff
+        # Read and delineate the record in segments of this many seconds, None reads the whole record
+        self.ecg_segment_duration = ecg_segment_duration
+        # "threshold" finds the R peaks above mean + 2 std, "streaming" uses the online Pan-Tompkins style detector
+        self.ecg_r_peak_detector = ecg_r_peak_detector
+        # Also save the HRV features (SDNN, RMSSD, pNN50, LF/HF) over the EEG windows to <channel>_hrv.csv
+        self.ecg_hrv = ecg_hrv
+        
+        # Format of the feature tables: "csv" writes one file per channel or clip,
+        # "parquet" writes one dataset per modality partitioned by source file and channel
+        self.output_format = output_format
+        # Write the audio and EEG features to memory-mapped tensors instead of tables: Audio/audio_tensor.npy
+        # (clips, frames, features) and EEG/eeg_tensor.npy (windows, channels, features), each with a .json index
+        # of the rows of every file. The audio summary takes precedence for the audio clips
+        self.export_tensors = export_tensors
         
         #  Audio Parameters
         self.audio_low_cutoff = audio_low_cutoff
@@ -19,4 +43,32 @@ class  Config:
         self.cmap = "coolwarm"
         self.window_type = "hann"
         self.fmin = 20
-        self.fmax = 8000
\ No newline at end of file
+        self.fmax = 8000
+        # Process each clip at the lowest rate sr / k that keeps the band and the fmax of the mel spectrogram.
+        # The content above the new Nyquist frequency is dropped: the spectral features and ZCR differ from those at sr
+        # by up to a few percent (see benchmarks/check_accuracy.py) and no MFCCs are computed
+        self.audio_native_rate = audio_native_rate
+        # Number of clips decoded and processed together as one array, 1 processes the clips one by one
+        self.audio_batch_size = audio_batch_size
+        # Keep the decoded and resampled clips as .npy files in this folder, up to audio_cache_size bytes (least recently used evicted)
+        self.audio_cache_dir = audio_cache_dir
+        self.audio_cache_size = audio_cache_size
+        # Only compute the spectral features and MFCCs on frames whose RMS is above this level in dB relative to the clip peak (e.g. -40), None keeps every frame
+        self.audio_gate_threshold = audio_gate_threshold
+        # Drop the gated frames from the CSV instead of writing NaN
+        self.audio_gate_drop = audio_gate_drop
+        # Write per-clip statistics (mean, std, min, max, percentiles, deltas) of every feature to Audio/audio_summary.csv
+        # instead of one CSV of frames per clip
+        self.audio_summary = audio_summary
+    
+    # Get the parameters that affect the features of a data type
+    def get_parameters(self, data_type):
+        return {name: getattr(self, name) for name in DATA_TYPE_PARAMETERS[data_type]}
+
+
+# Config parameters used by each data type, a change in any of them invalidates the extracted features
+DATA_TYPE_PARAMETERS = {
+    "EEG": ["window_duration", "time_step", "eeg_engine", "eeg_rolling_moments", "eeg_block_duration", "eeg_decimate", "output_format", "export_tensors"],
+    "ECG": ["ecg_low_cutoff", "ecg_high_cutoff", "ecg_segment_duration", "ecg_r_peak_detector", "ecg_hrv", "window_duration", "time_step", "output_format"],
+    "Audio": ["audio_low_cutoff", "audio_high_cutoff", "n_fft", "sr", "hop_length", "fmin", "fmax", "audio_native_rate", "audio_gate_threshold", "audio_gate_drop", "audio_summary", "output_format", "export_tensors"],
+}
@@ -1,19 +1,61 @@
 import os
+from fnmatch import fnmatch
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
 from Signal_Processing import ECG_processing as ecg
 from Signal_Processing import EEG_processing as eeg
 from Audio import Audio_processing as audio
+from manifest import Manifest
+from output_backend import get_backend
+import instrumentation
+from tensor_export import save_tensor
 from pathlib import Path
 
 
+# Axes of the exported tensor of each data type
+TENSOR_DIMS = {
+    "Audio": ["clips", "frames", "features"],
+    "EEG": ["windows", "channels", "features"],
+}
+
+# DataLoader used by the current worker process, set once by the pool initializer
+_worker_loader = None
+
+# Keep a copy of the DataLoader in each worker process, with the instrumentation settings of the parent
+def _init_worker(loader, instrumentation_state):
+    global _worker_loader
+    _worker_loader = loader
+    instrumentation.set_state(instrumentation_state)
+
+# Load a batch of files inside a worker process
+def _run_worker(file_paths):
+    return _worker_loader.load_batch(file_paths)
+
 
 class DataLoader:
     # Initialize the DataLoader with the data path and save path
-    def __init__(self, data_path, save_path, config):
+    def __init__(self, data_path, save_path, config, n_workers=1, force=False, recursive=False, include=None, exclude=None):
         # Set the data path and save path
         self.data_path = data_path
         self.save_path = save_path
         self.config = config
         
+        # Number of worker processes, 1 processes the files serially
+        self.n_workers = n_workers
+        
+        # Re-extract every file even if the manifest says it is up to date
+        self.force = force
+        
+        # Also load the files in the subfolders of the data path, the folder of a file is its label in the exported tensors
+        self.recursive = recursive
+        
+        # Glob patterns on the paths relative to the data path (e.g. "*.edf", "snore/*"): only the files matching
+        # one of include (all files if None) and none of exclude are loaded
+        self.include = include
+        self.exclude = exclude or []
+        
+        # Filters, window and mel basis of the audio features, built on the first audio file (see get_audio_plan)
+        self.audio_plan = None
         
         # Supported file formats
         self.audio_format = ['.mp3', '.ogg', '.flac', '.m4a']
@@ -26,29 +68,310 @@ class DataLoader:
         _, file_extension = os.path.splitext(file_path)
         return file_extension.lower()
     
+    # Get the data type of the file, None if it is not supported
+    def get_data_type(self, file_path):
+        file_type = self.get_file_type(file_path)
+        if file_type in self.eeg_format:
+            return "EEG"
+        if file_type in self.ecg_format:
+            return "ECG"
+        if file_type in self.audio_format:
+            return "Audio"
+        return None
+    
+    # Get the files the features are computed from (WFDB records also need their header)
+    def get_source_files(self, file_path):
+        if self.get_data_type(file_path) == "ECG":
+            return [file_path, f"{os.path.splitext(file_path)[0]}.hea"]
+        return [file_path]
+    
+    
+    # Get the audio feature plan, built once per process when the first clip is loaded so that the audio
+    # settings of a job without audio files are never checked
+    def get_audio_plan(self):
+        if self.audio_plan is None:
+            self.audio_plan = audio.AudioFeaturePlan(self.config)
+        return self.audio_plan
+    
+    
+    # Get the paths of the files in the data path, and in its subfolders if recursive (except the save folder)
+    def get_file_paths(self):
+        if not self.recursive:
+            file_paths = [os.path.join(self.data_path, file) for file in os.listdir(self.data_path)]
+        else:
+            save_path = os.path.abspath(self.save_path)
+            file_paths = []
+            for folder, subfolders, files in os.walk(self.data_path):
+                subfolders[:] = sorted(
+                    subfolder for subfolder in subfolders if os.path.abspath(os.path.join(folder, subfolder)) != save_path
+                )
+                file_paths += [os.path.join(folder, file) for file in sorted(files)]
+        return [file_path for file_path in file_paths if self.is_selected(file_path)]
+    
+    # Check a file against the include and exclude patterns
+    def is_selected(self, file_path):
+        name = self.get_source_name(file_path)
+        if self.include is not None and not any(fnmatch(name, pattern) for pattern in self.include):
+            return False
+        return not any(fnmatch(name, pattern) for pattern in self.exclude)
+    
+    # Name of a file in the exported tensors, its path relative to the data path
+    def get_source_name(self, file_path):
+        return os.path.relpath(file_path, self.data_path)
+    
+    # Name the features of a file are saved under, its source name without the extension (e.g. snore/1)
+    def get_output_name(self, file_path):
+        return os.path.splitext(self.get_source_name(file_path))[0]
+    
+    # Label of a file in the exported tensors, the name of its folder (e.g. snore or traffic)
+    def get_label(self, file_path):
+        return os.path.basename(os.path.dirname(os.path.abspath(file_path)))
+    
     
     # Load the data from the data path
     def load_data(self):
         # Get the list of files in the data path
-        files = os.listdir(self.data_path)
-        # Load the data from each file
-        for file in files:
-            # Get the file and check if it is supported
-            file_path = os.path.join(self.data_path, file)
-            file_type = self.get_file_type(file_path)
+        file_paths = self.get_file_paths()
+        manifest = Manifest(self.save_path)
+        
+        # Skip the files that were already extracted with the same parameters
+        results = {}
+        pending = []
+        for file_path in file_paths:
+            data_type = self.get_data_type(file_path)
+            if data_type is not None and not self.force and manifest.is_up_to_date(
+                file_path, self.get_source_files(file_path), self.config.get_parameters(data_type)
+            ):
+                print(f"Skipping {file_path}, features are up to date")
+                results[file_path] = {"file": file_path, "status": "skipped", "error": None, "outputs": []}
+            else:
+                pending.append(file_path)
+        
+        # Load the data from each file, one result per file
+        try:
+            batches = self.get_batches(pending)
+            if self.n_workers > 1:
+                loaded = self.load_parallel(batches)
+            else:
+                loaded = [result for batch in batches for result in self.load_batch(batch)]
             
-            # Load the data based on the file type
-            if file_type in self.eeg_format:
-                self.load_eeg(file_path)
+            # The audio summaries go to one table, written before the clips are recorded
+            if self.config.audio_summary:
+                with instrumentation.stage("summary_table"):
+                    self.save_audio_summary(results, loaded)
             
-            elif file_type in self.ecg_format:
-                self.load_ecg(file_path)
+            # The exported features go to one tensor per data type, also written before the files are recorded
+            if self.config.export_tensors:
+                with instrumentation.stage("tensors"):
+                    self.save_tensors(results, loaded)
             
-            elif file_type in self.audio_format:
-                self.load_audio(file_path)
+            # Record the outputs of the newly extracted files
+            for result in loaded:
+                results[result["file"]] = result
+                if result["status"] == "success":
+                    file_path = result["file"]
+                    data_type = self.get_data_type(file_path)
+                    manifest.record(
+                        file_path, self.get_source_files(file_path), self.config.get_parameters(data_type), result["outputs"]
+                    )
+        finally:
+            manifest.save()
+        
+        return [results[file_path] for file_path in file_paths]
+    
+    # Group the files into the tasks they are loaded in: audio clips by audio_batch_size, any other file alone
+    def get_batches(self, file_paths):
+        batch_size = getattr(self.config, "audio_batch_size", 1)
+        audio_files = [file_path for file_path in file_paths if self.get_data_type(file_path) == "Audio"]
+        batches = [[file_path] for file_path in file_paths if batch_size <= 1 or self.get_data_type(file_path) != "Audio"]
+        if batch_size > 1:
+            batches += [audio_files[start:start + batch_size] for start in range(0, len(audio_files), batch_size)]
+        return batches
+    
+    # Load the files in a process pool, one task per batch
+    def load_parallel(self, batches):
+        results = {}
+        unfinished = self.run_pool(batches, results)
+        
+        # A worker that dies (e.g. killed out of memory) breaks the pool and every batch it had not finished,
+        # retry their files one at a time so only the file that crashed is failed
+        self.retry_files([file_path for batch in unfinished for file_path in batch], results)
+        
+        # Report the results in the same order as the serial path
+        return [results[file_path] for batch in batches for file_path in batch]
+    
+    # Create the process pool, each worker gets a copy of the loader
+    def make_executor(self, n_workers):
+        return ProcessPoolExecutor(max_workers=n_workers, initializer=_init_worker, initargs=(self, instrumentation.get_state()))
+    
+    # Load the batches in a pool of n_workers processes, returns the batches left unfinished if the pool broke
+    def run_pool(self, batches, results):
+        unfinished = []
+        with self.make_executor(self.n_workers) as executor:
+            futures = {}
+            for batch in batches:
+                try:
+                    futures[executor.submit(_run_worker, batch)] = batch
+                except BrokenProcessPool:
+                    unfinished.append(batch)
             
-            else:
-                print(f"Unsupported file format: {file_type}")
+            for future in as_completed(futures):
+                batch = futures[future]
+                try:
+                    for result in future.result():
+                        results[result["file"]] = result
+                except BrokenProcessPool:
+                    unfinished.append(batch)
+                except Exception as error:
+                    # The batch could not be sent to or back from the worker, record its files as failed
+                    for file_path in batch:
+                        print(f"Failed to load {file_path}: {error}")
+                        results[file_path] = {"file": file_path, "status": "failed", "error": repr(error), "outputs": []}
+        return unfinished
+    
+    # Load the files one at a time in a single worker process, replaced after each file that crashes it
+    def retry_files(self, file_paths, results):
+        executor = None
+        try:
+            for file_path in file_paths:
+                executor = executor or self.make_executor(1)
+                try:
+                    for result in executor.submit(_run_worker, [file_path]).result():
+                        results[result["file"]] = result
+                except Exception as error:
+                    print(f"Failed to load {file_path}: {error}")
+                    results[file_path] = {"file": file_path, "status": "failed", "error": repr(error), "outputs": []}
+                    if isinstance(error, BrokenProcessPool):
+                        executor.shutdown()
+                        executor = None
+        finally:
+            if executor is not None:
+                executor.shutdown()
+    
+    # Load a batch of files, a single file goes through load_file
+    def load_batch(self, file_paths):
+        if len(file_paths) == 1:
+            return [self.load_file(file_paths[0])]
+        
+        try:
+            with instrumentation.context(files=file_paths), instrumentation.stage("batch", data_type="Audio"):
+                if self.config.audio_summary:
+                    summaries = self.load_audio_summary(file_paths)
+                elif self.config.export_tensors:
+                    tensors = self.load_audio_tensor(file_paths)
+                else:
+                    outputs = self.load_audio_batch(file_paths)
+        except Exception as error:
+            # One bad clip fails the whole batch, load the clips one by one to isolate it
+            print(f"Failed to load the batch of {len(file_paths)} clips: {error}, loading them one by one")
+            return [self.load_file(file_path) for file_path in file_paths]
+        
+        if self.config.audio_summary:
+            return [
+                {"file": file_path, "status": "success", "error": None, "outputs": [], "summary": summary}
+                for file_path, summary in zip(file_paths, summaries)
+            ]
+        if self.config.export_tensors:
+            return [
+                {"file": file_path, "status": "success", "error": None, "outputs": [], "tensor": tensor}
+                for file_path, tensor in zip(file_paths, tensors)
+            ]
+        return [
+            {"file": file_path, "status": "success", "error": None, "outputs": [str(output) for output in file_outputs]}
+            for file_path, file_outputs in zip(file_paths, outputs)
+        ]
+    
+    # Write the summaries of the new clips to the corpus table, with the rows of the skipped clips kept
+    def save_audio_summary(self, results, loaded):
+        keep = [
+            self.get_source_name(file_path) for file_path, result in results.items()
+            if result["status"] == "skipped" and self.get_data_type(file_path) == "Audio"
+        ]
+        summaries = [result["summary"] for result in loaded if "summary" in result]
+        
+        audio_folder_path = Path(self.save_path) / "Audio"
+        audio_folder_path.mkdir(parents=True, exist_ok=True)
+        table_path = audio.save_summary_table(summaries, audio_folder_path, keep, get_backend(self.config))
+        
+        # Every summarized clip has its row in the table
+        for result in loaded:
+            if "summary" in result:
+                result["outputs"] = [str(table_path)]
+    
+    # Write the arrays of the new files to the tensor of their data type, with the rows of the skipped files kept
+    def save_tensors(self, results, loaded):
+        for data_type, dims in TENSOR_DIMS.items():
+            keep = [
+                self.get_source_name(file_path) for file_path, result in results.items()
+                if result["status"] == "skipped" and self.get_data_type(file_path) == data_type
+            ]
+            exported = [result for result in loaded if "tensor" in result and self.get_data_type(result["file"]) == data_type]
+            if not keep and not exported:
+                continue
+            
+            # The arrays are not kept in the results once they are in the tensor
+            parts = [
+                {"source": self.get_source_name(result["file"]), "label": self.get_label(result["file"]), **result.pop("tensor")}
+                for result in exported
+            ]
+            folder_path = Path(self.save_path) / data_type
+            folder_path.mkdir(parents=True, exist_ok=True)
+            output_paths = save_tensor(
+                [part for part in parts if "values" in part], folder_path, f"{data_type.lower()}_tensor", dims, keep,
+                self.get_tensor_attrs(data_type),
+            )
+            
+            # Every exported file has its rows in the tensor
+            for result in exported:
+                result["outputs"] = [str(output) for output in output_paths]
+    
+    # Settings stored in the index of the tensor of a data type, to place its rows in time
+    def get_tensor_attrs(self, data_type):
+        if data_type == "Audio":
+            return {"frame_period": self.config.hop_length / self.config.sr}
+        return {"window_duration": self.config.window_duration, "time_step": self.config.time_step}
+    
+    # Load a single file and report whether it succeeded
+    def load_file(self, file_path):
+        # Get the file and check if it is supported
+        data_type = self.get_data_type(file_path)
+        
+        # Time the whole file, the records of its stages carry its path
+        with instrumentation.context(file=file_path), instrumentation.stage("file", data_type=data_type):
+            try:
+                # Load the data based on the file type
+                if data_type == "EEG" and self.config.export_tensors:
+                    # The arrays go to the EEG tensor once all the recordings are loaded
+                    tensor = self.load_eeg_tensor(file_path) or {}
+                    return {"file": file_path, "status": "success", "error": None, "outputs": [], "tensor": tensor}
+                
+                elif data_type == "EEG":
+                    outputs = self.load_eeg(file_path)
+                
+                elif data_type == "ECG":
+                    outputs = self.load_ecg(file_path)
+                
+                elif data_type == "Audio" and self.config.audio_summary:
+                    # The summary goes to the corpus table once all the clips are loaded
+                    summary = self.load_audio_summary([file_path])[0]
+                    return {"file": file_path, "status": "success", "error": None, "outputs": [], "summary": summary}
+                
+                elif data_type == "Audio" and self.config.export_tensors:
+                    tensor = self.load_audio_tensor([file_path])[0]
+                    return {"file": file_path, "status": "success", "error": None, "outputs": [], "tensor": tensor}
+                
+                elif data_type == "Audio":
+                    outputs = self.load_audio(file_path)
+            
+                else:
+                    print(f"Unsupported file format: {self.get_file_type(file_path)}")
+                    return {"file": file_path, "status": "unsupported", "error": None, "outputs": []}
+            except Exception as error:
+                # Keep going with the other files if this one fails
+                print(f"Failed to load {file_path}: {error}")
+                return {"file": file_path, "status": "failed", "error": repr(error), "outputs": []}
+            
+            return {"file": file_path, "status": "success", "error": None, "outputs": [str(output) for output in outputs]}
     
     # Load the EEG features from the file
     def load_eeg(self, file_path):
@@ -56,7 +379,7 @@ class DataLoader:
         eeg_folder_path = Path(self.save_path) / "EEG"
         eeg_folder_path.mkdir(parents=True, exist_ok=True)
         
-        eeg.extract_eeg_features(file_path, eeg_folder_path, self.config)
+        return eeg.extract_eeg_features(file_path, eeg_folder_path, self.config, self.get_output_name(file_path))
     
     # Load the ECG features from the file
     def load_ecg(self, file_path):
@@ -64,7 +387,7 @@ class DataLoader:
         ecg_folder_path = Path(self.save_path) / "ECG"
         ecg_folder_path.mkdir(parents=True, exist_ok=True)
         
-        ecg.extract_ecg_features(file_path, ecg_folder_path, self.config)
+        return ecg.extract_ecg_features(file_path, ecg_folder_path, self.config)
     
     # Load the Audio features from the file
     def load_audio(self, file_path):
@@ -72,5 +395,32 @@ class DataLoader:
         audio_folder_path = Path(self.save_path) / "Audio"
         audio_folder_path.mkdir(parents=True, exist_ok=True)
         
-        audio.extract_audio_features(file_path, audio_folder_path, self.config)
-
+        return audio.extract_audio_features(
+            file_path, audio_folder_path, self.config, self.get_audio_plan(), self.get_output_name(file_path)
+        )
+    
+    # Load the Audio features of several clips processed together
+    def load_audio_batch(self, file_paths):
+        audio_folder_path = Path(self.save_path) / "Audio"
+        audio_folder_path.mkdir(parents=True, exist_ok=True)
+        
+        return audio.extract_audio_features_batch(
+            file_paths, audio_folder_path, self.config, self.get_audio_plan(), [self.get_output_name(file_path) for file_path in file_paths]
+        )
+    
+    # Summarize the Audio features of clips, one row per clip
+    # The rows are named by the source name of the clip and labeled with its folder, like in the tensors
+    def load_audio_summary(self, file_paths):
+        summaries = audio.extract_audio_summary_batch(file_paths, self.config, self.get_audio_plan())
+        return [
+            {**summary, "file": self.get_source_name(file_path), "label": self.get_label(file_path)}
+            for file_path, summary in zip(file_paths, summaries)
+        ]
+    
+    # Feature arrays of clips for the tensor export
+    def load_audio_tensor(self, file_paths):
+        return audio.extract_audio_tensor_batch(file_paths, self.config, self.get_audio_plan())
+    
+    # Feature array of the EEG channels of a recording for the tensor export, None without EEG channels
+    def load_eeg_tensor(self, file_path):
+        return eeg.extract_eeg_tensor(file_path, self.config)
@@ -0,0 +1,163 @@
+import json
+import os
+import time
+import tracemalloc
+from functools import wraps
+
+
+# Sink the stage records go to, None disables the instrumentation
+_sink = None
+# Also record the peak memory allocated in each stage with tracemalloc
+_trace_memory = False
+# Fields added to every record (e.g. the file and channel being processed), innermost last
+_context = []
+# Stages being timed, innermost last
+_stages = []
+
+
+# Write the records as JSON lines appended to a file, each process appends its own lines
+class JsonLinesSink:
+    def __init__(self, path):
+        self.path = path
+
+    def write(self, record):
+        with open(self.path, "a") as file:
+            file.write(json.dumps(record, default=str) + "\n")
+
+
+# Keep the records in a list, e.g. to check them in tests
+# The records of worker processes stay in the workers, use n_workers=1 to collect them all
+class MemorySink:
+    def __init__(self):
+        self.records = []
+
+    def write(self, record):
+        self.records.append(record)
+
+
+# Send the records of the stages to sink, until disable() is called
+def enable(sink, trace_memory=False):
+    global _sink, _trace_memory
+    _sink = sink
+    _trace_memory = trace_memory
+
+def disable():
+    global _sink, _trace_memory
+    _sink = None
+    _trace_memory = False
+
+def is_enabled():
+    return _sink is not None
+
+# Settings to pass to a worker process, restored there with set_state
+def get_state():
+    return _sink, _trace_memory
+
+def set_state(state):
+    if state[0] is None:
+        disable()
+    else:
+        enable(*state)
+
+
+# Stage that does nothing, used while the instrumentation is disabled
+class _NullStage:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+_NULL_STAGE = _NullStage()
+
+
+# Time a stage and write its record to the sink when it ends, with the peak memory it allocated if traced
+class Stage:
+    def __init__(self, name, fields):
+        self.name = name
+        self.fields = fields
+        self.started_tracing = False
+
+    def __enter__(self):
+        self.traced = _trace_memory
+        if self.traced:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+                self.started_tracing = True
+            # The peak so far belongs to the enclosing stage, the peak is then measured from here
+            current, peak = tracemalloc.get_traced_memory()
+            if _stages:
+                _stages[-1].peak = max(_stages[-1].peak, peak)
+            tracemalloc.reset_peak()
+            self.memory = self.peak = current
+        _stages.append(self)
+        self.time = time.time()
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        seconds = time.perf_counter() - self.start
+        _stages.pop()
+
+        record = {"stage": self.name}
+        for fields in _context:
+            record.update(fields)
+        record.update(self.fields)
+        record.update({"time": self.time, "seconds": seconds, "pid": os.getpid()})
+        if exc_type is not None:
+            record["error"] = repr(exc_value)
+
+        if self.traced and tracemalloc.is_tracing():
+            _, peak = tracemalloc.get_traced_memory()
+            self.peak = max(self.peak, peak)
+            record["peak_bytes"] = self.peak - self.memory
+            if _stages:
+                _stages[-1].peak = max(_stages[-1].peak, self.peak)
+        if self.started_tracing:
+            tracemalloc.stop()
+
+        # The sink may have been disabled inside the stage
+        if _sink is not None:
+            _sink.write(record)
+        return False
+
+# Context manager timing a stage, the fields are added to its record: with stage("filter", channel=name): ...
+def stage(name, **fields):
+    if _sink is None:
+        return _NULL_STAGE
+    return Stage(name, fields)
+
+# Decorator timing every call of a function as a stage, named after the function by default
+def timed(name=None):
+    def decorator(function):
+        stage_name = name or function.__name__
+
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            if _sink is None:
+                return function(*args, **kwargs)
+            with Stage(stage_name, {}):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+# Fields added to the records of the stages inside it
+class Context:
+    def __init__(self, fields):
+        self.fields = fields
+
+    def __enter__(self):
+        _context.append(self.fields)
+        return self
+
+    def __exit__(self, *exc_info):
+        _context.pop()
+        return False
+
+# Context manager adding fields to the records of the stages inside it, e.g. the file being processed:
+# with context(file=path): ...
+def context(**fields):
+    if _sink is None:
+        return _NULL_STAGE
+    return Context(fields)
@@ -150,6 +150,19 @@ class DataLoaderUI:
         self.hop_length_entry = tk.Entry(self.audio_frame, font=font)
         self.hop_length_entry.grid(row=3, column=1)
 
+        # Processing Parameters Frame
+        self.processing_frame = tk.LabelFrame(
+            master, text="Processing Parameters", padx=10, pady=10, font=font
+        )
+        self.processing_frame.pack(padx=10, pady=10)
+
+        self.n_workers_label = tk.Label(
+            self.processing_frame, text="Number of Workers:", font=font
+        )
+        self.n_workers_label.grid(row=0, column=0, sticky="e")
+        self.n_workers_entry = tk.Entry(self.processing_frame, font=font)
+        self.n_workers_entry.insert(0, "1")
+        self.n_workers_entry.grid(row=0, column=1)
 
         # Load Data Button
         self.load_button = tk.Button(
@@ -238,6 +251,7 @@ class DataLoaderUI:
             audio_high_cutoff = float(self.audio_high_cutoff_entry.get())
             sr = int(self.sr_entry.get())
             hop_length = int(self.hop_length_entry.get())
+            n_workers = int(self.n_workers_entry.get())
             config = Config(
                 window_duration,
                 time_step,
@@ -256,10 +270,17 @@ class DataLoaderUI:
 
         if self.data_folder_path and self.save_folder_path:
             dataloader = DataLoader(
-                self.data_folder_path, self.save_folder_path, config
+                self.data_folder_path, self.save_folder_path, config, n_workers
             )
-            dataloader.load_data()
-            self.show_custom_message("Data Loading", "Data loading completed.")
+            results = dataloader.load_data()
+            failed = [result for result in results if result["status"] == "failed"]
+            if failed:
+                self.show_custom_message(
+                    "Data Loading",
+                    f"Data loading completed with {len(failed)} failed file(s).",
+                )
+            else:
+                self.show_custom_message("Data Loading", "Data loading completed.")
         else:
             self.show_custom_message(
                 "Folder Selection Incomplete",
@@ -0,0 +1,74 @@
+import hashlib
+import json
+import os
+
+
+# Hash the content of a file, reading it in chunks
+def file_hash(file_path, chunk_size=1 << 20):
+    digest = hashlib.sha256()
+    with open(file_path, "rb") as file:
+        for chunk in iter(lambda: file.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+# Get the size and modification time of a file
+def file_stat(file_path):
+    stat = os.stat(file_path)
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+# Manifest of the extracted files, stored as JSON in the save folder
+class Manifest:
+    # Load the manifest from the save folder if it exists
+    def __init__(self, save_path, file_name="manifest.json"):
+        self.save_path = save_path
+        self.path = os.path.join(save_path, file_name)
+        self.entries = {}
+        if os.path.exists(self.path):
+            with open(self.path) as file:
+                self.entries = json.load(file)
+
+    # Check if the input was already extracted with the same parameters
+    def is_up_to_date(self, file_path, source_paths, params):
+        entry = self.entries.get(os.path.abspath(file_path))
+        if entry is None or entry["params"] != _normalize(params):
+            return False
+
+        # Every output of the previous run must still exist
+        if not all(os.path.exists(os.path.join(self.save_path, output)) for output in entry["outputs"]):
+            return False
+
+        # Fast path: same size and modification time for all the source files
+        stats = [file_stat(source_path) for source_path in source_paths]
+        if stats == entry["stats"]:
+            return True
+
+        # Otherwise compare the content, the file may only have been touched
+        if [file_hash(source_path) for source_path in source_paths] != entry["hashes"]:
+            return False
+        entry["stats"] = stats
+        return True
+
+    # Record the outputs produced for an input
+    def record(self, file_path, source_paths, params, outputs):
+        self.entries[os.path.abspath(file_path)] = {
+            "sources": [os.path.abspath(source_path) for source_path in source_paths],
+            "stats": [file_stat(source_path) for source_path in source_paths],
+            "hashes": [file_hash(source_path) for source_path in source_paths],
+            "params": _normalize(params),
+            "outputs": [os.path.relpath(output, self.save_path) for output in outputs],
+        }
+
+    # Write the manifest, replacing the old one only once it is complete
+    def save(self):
+        os.makedirs(self.save_path, exist_ok=True)
+        temp_path = f"{self.path}.tmp"
+        with open(temp_path, "w") as file:
+            json.dump(self.entries, file, indent=2)
+        os.replace(temp_path, self.path)
+
+
+# Round-trip the parameters through JSON so they compare equal to the stored ones
+def _normalize(params):
+    return json.loads(json.dumps(params))
@@ -0,0 +1,154 @@
+import os
+import numpy as np
+import pandas as pd
+
+
+# Write the feature tables as one csv per channel (or clip) in the modality folder
+# A table other than the main features gets its name as a suffix (e.g. 1_hrv.csv)
+class CsvBackend:
+    extension = ".csv"
+
+    # Path of the table of a channel, the csv files are only named after the channel
+    # (a clip of a subfolder of the data path, e.g. snore/1, is saved in the same subfolder)
+    def path(self, save_path, source, channel_name, table="features"):
+        if table != "features":
+            channel_name = f"{channel_name}_{table}"
+        csv_path = os.path.join(save_path, f"{channel_name}.csv")
+        os.makedirs(os.path.dirname(csv_path), exist_ok=True)
+        return csv_path
+
+    # Write the whole table of a channel
+    def write(self, df, save_path, source, channel_name, table="features"):
+        csv_path = self.path(save_path, source, channel_name, table)
+        df.to_csv(csv_path, index=False)
+        return csv_path
+
+    # Open a writer that adds the rows of a channel a few at a time
+    def writer(self, save_path, source, channel_name, table="features"):
+        return CsvWriter(self, save_path, source, channel_name, table)
+
+    # Write and read a table that is not split by source and channel (e.g. the corpus summaries)
+    def write_table(self, df, save_path, name):
+        table_path = os.path.join(save_path, f"{name}.csv")
+        # Write to a temporary file first so an interrupted run keeps the previous table
+        tmp_path = f"{table_path}.tmp"
+        df.to_csv(tmp_path, index=False)
+        os.replace(tmp_path, table_path)
+        return table_path
+
+    def read_table(self, save_path, name):
+        table_path = os.path.join(save_path, f"{name}.csv")
+        return pd.read_csv(table_path) if os.path.exists(table_path) else None
+
+
+# Rows appended to the csv of a channel, the first rows create the file and its header
+class CsvWriter:
+    def __init__(self, backend, save_path, source, channel_name, table="features"):
+        self.backend = backend
+        self.save_path = save_path
+        self.source = source
+        self.channel_name = channel_name
+        self.table = table
+        self.csv_path = backend.path(save_path, source, channel_name, table)
+        self.first = True
+
+    def write(self, df):
+        df.to_csv(self.csv_path, mode='w' if self.first else 'a', header=self.first, index=False)
+        self.first = False
+
+    # Finish the file, a channel without rows gets an empty table
+    def close(self):
+        if self.first:
+            return self.backend.write(pd.DataFrame(), self.save_path, self.source, self.channel_name, self.table)
+        return self.csv_path
+
+
+# Write the feature tables as Parquet datasets in the modality folder, one per kind of table, partitioned by
+# source file and channel (<save_path>/<table>/source=<file>/channel=<channel>/part-0.parquet), with float32
+# columns and compression
+class ParquetBackend:
+    extension = ".parquet"
+
+    def __init__(self, compression="zstd"):
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError:
+            raise ImportError("The parquet output format needs pyarrow, install it or use the csv format.")
+        self.pa = pyarrow
+        self.pq = pyarrow.parquet
+        self.compression = compression
+
+    # Path of the table of a channel, its folder names give the partition values
+    def path(self, save_path, source, channel_name, table="features"):
+        folder = os.path.join(save_path, table, f"source={partition_value(source)}", f"channel={partition_value(channel_name)}")
+        os.makedirs(folder, exist_ok=True)
+        return os.path.join(folder, "part-0.parquet")
+
+    # Arrow table of the features, the float columns are stored as float32
+    def to_arrow(self, df):
+        df = df.astype({column: np.float32 for column in df.columns if df[column].dtype == np.float64})
+        return self.pa.Table.from_pandas(df, preserve_index=False)
+
+    def write(self, df, save_path, source, channel_name, table="features"):
+        parquet_path = self.path(save_path, source, channel_name, table)
+        self.pq.write_table(self.to_arrow(df), parquet_path, compression=self.compression)
+        return parquet_path
+
+    def writer(self, save_path, source, channel_name, table="features"):
+        return ParquetWriter(self, save_path, source, channel_name, table)
+
+    def write_table(self, df, save_path, name):
+        table_path = os.path.join(save_path, f"{name}.parquet")
+        tmp_path = f"{table_path}.tmp"
+        self.pq.write_table(self.to_arrow(df), tmp_path, compression=self.compression)
+        os.replace(tmp_path, table_path)
+        return table_path
+
+    def read_table(self, save_path, name):
+        table_path = os.path.join(save_path, f"{name}.parquet")
+        return pd.read_parquet(table_path) if os.path.exists(table_path) else None
+
+
+# Row groups appended to the Parquet file of a channel, the schema comes from the first rows
+class ParquetWriter:
+    def __init__(self, backend, save_path, source, channel_name, table="features"):
+        self.backend = backend
+        self.save_path = save_path
+        self.source = source
+        self.channel_name = channel_name
+        self.table = table
+        self.parquet_path = backend.path(save_path, source, channel_name, table)
+        self.writer = None
+
+    def write(self, df):
+        table = self.backend.to_arrow(df)
+        if self.writer is None:
+            self.writer = self.backend.pq.ParquetWriter(self.parquet_path, table.schema, compression=self.backend.compression)
+        self.writer.write_table(table)
+
+    def close(self):
+        if self.writer is None:
+            return self.backend.write(pd.DataFrame(), self.save_path, self.source, self.channel_name, self.table)
+        self.writer.close()
+        return self.parquet_path
+
+
+# Keep a partition value inside its folder name, URI-escaped so the datasets read the value back
+# (e.g. the clip snore/1 of a subfolder is in source=snore%2F1)
+def partition_value(value):
+    return str(value).replace("%", "%25").replace("/", "%2F").replace(os.sep, "%2F").replace("=", "%3D")
+
+
+# Output formats that can be selected with Config.output_format
+BACKENDS = {
+    "csv": CsvBackend,
+    "parquet": ParquetBackend,
+}
+
+# Get the backend of the output format of the config, csv if it has none
+def get_backend(config):
+    output_format = getattr(config, "output_format", "csv")
+    if output_format not in BACKENDS:
+        raise ValueError(f"Unknown output format {output_format}, expected one of {', '.join(BACKENDS)}.")
+    return BACKENDS[output_format]()
@@ -0,0 +1,108 @@
+import json
+import os
+import numpy as np
+from numpy.lib.format import open_memmap
+
+
+# Values of the tensors, stored as float32 like the Parquet features
+TENSOR_DTYPE = np.float32
+
+
+# Write the features of several files to one memory-mapped tensor <name>.npy and its index <name>.json
+# Each part holds the rows of one file: its source, label, values (rows, ...) and the labels along the named axes of dims
+# (e.g. channels, features), the other axes (e.g. frames) are padded with NaN to the longest part
+# The parts of the sources in keep are carried over from the previous tensor, attrs are added to the index
+def save_tensor(parts, save_path, name, dims, keep=(), attrs=None):
+    parts = previous_parts(save_path, name, keep) + list(parts)
+    parts.sort(key=lambda part: part["source"])
+
+    # Labels of the named axes in order of first appearance, a part without some of them has NaN there
+    coords = {}
+    for part in parts:
+        for dim, labels in part["coords"].items():
+            known = coords.setdefault(dim, [])
+            known += [label for label in labels if label not in known]
+    positions = {dim: {label: i for i, label in enumerate(labels)} for dim, labels in coords.items()}
+    shape = [sum(len(part["values"]) for part in parts)]
+    for axis, dim in enumerate(dims[1:], start=1):
+        shape.append(len(coords[dim]) if dim in coords else max((part["values"].shape[axis] for part in parts), default=0))
+
+    # Write to a temporary file, the previous tensor may still be read from
+    tensor_path = os.path.join(save_path, f"{name}.npy")
+    tmp_path = os.path.join(save_path, f"{name}.tmp.npy")
+    tensor = open_memmap(tmp_path, mode="w+", dtype=TENSOR_DTYPE, shape=tuple(shape))
+
+    files = []
+    start = 0
+    for part in parts:
+        values = part["values"]
+        stop = start + len(values)
+
+        # Place the values of the part along each axis of the tensor, one part at a time
+        index = [np.arange(len(values))]
+        for axis, dim in enumerate(dims[1:], start=1):
+            if dim in coords:
+                index.append(np.array([positions[dim][label] for label in part["coords"][dim]], dtype=int))
+            else:
+                index.append(np.arange(values.shape[axis]))
+        block = np.full((len(values),) + tuple(shape[1:]), np.nan, dtype=TENSOR_DTYPE)
+        block[np.ix_(*index)] = values
+        tensor[start:stop] = block
+
+        # Rows of the file, with its labels where they are not those of the whole tensor
+        entry = {key: value for key, value in part.items() if key not in ("values", "coords")}
+        entry.update({"start": start, "stop": stop, "shape": list(values.shape[1:])})
+        entry["coords"] = {dim: labels for dim, labels in part["coords"].items() if labels != coords[dim]}
+        files.append(entry)
+        start = stop
+
+    tensor.flush()
+    del tensor
+    os.replace(tmp_path, tensor_path)
+
+    index_path = os.path.join(save_path, f"{name}.json")
+    index = {"dims": list(dims), "shape": shape, "dtype": np.dtype(TENSOR_DTYPE).name, "coords": coords, **(attrs or {}), "files": files}
+    tmp_path = f"{index_path}.tmp"
+    with open(tmp_path, "w") as file:
+        json.dump(index, file, indent=2)
+    os.replace(tmp_path, index_path)
+    return tensor_path, index_path
+
+# Load the index of a tensor, None if it was not exported yet
+def load_tensor_index(save_path, name):
+    index_path = os.path.join(save_path, f"{name}.json")
+    if not os.path.exists(index_path):
+        return None
+    with open(index_path) as file:
+        return json.load(file)
+
+# Memory-map a tensor and load its index
+def load_tensor(save_path, name, mode="r"):
+    return np.load(os.path.join(save_path, f"{name}.npy"), mmap_mode=mode), load_tensor_index(save_path, name)
+
+# Parts of the sources in keep, read back from the previous tensor without its padding
+def previous_parts(save_path, name, keep):
+    index = load_tensor_index(save_path, name) if keep else None
+    if index is None or not os.path.exists(os.path.join(save_path, f"{name}.npy")):
+        return []
+    tensor, _ = load_tensor(save_path, name)
+
+    keep = set(keep)
+    parts = []
+    for entry in index["files"]:
+        if entry["source"] not in keep:
+            continue
+        coords = {dim: entry["coords"].get(dim, labels) for dim, labels in index["coords"].items()}
+        selection = [slice(entry["start"], entry["stop"])]
+        for dim, size in zip(index["dims"][1:], entry["shape"]):
+            if dim in coords:
+                positions = {label: i for i, label in enumerate(index["coords"][dim])}
+                selection.append(np.array([positions[label] for label in coords[dim]], dtype=int))
+            else:
+                selection.append(np.arange(size))
+        values = tensor[selection[0]][np.ix_(np.arange(entry["stop"] - entry["start"]), *selection[1:])]
+
+        part = {key: value for key, value in entry.items() if key not in ("start", "stop", "shape", "coords")}
+        part.update({"values": np.asarray(values), "coords": coords})
+        parts.append(part)
+    return parts